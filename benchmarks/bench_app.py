@@ -0,0 +1,19 @@
+"""WSGI entry point for load tests: the portal app wired to the fake Google backend.
+
+    gunicorn -w 4 benchmarks.bench_app:app
+
+loadtest.py starts gunicorn with this module itself; the database comes from DATABASE_URL
+and BENCH_GOOGLE_LATENCY_MS adds a per-call delay to the fake Sheets/Drive APIs.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('EXPIRY_SCHEDULER', '0')
+
+import main  # noqa: E402
+from benchmarks import fake_google  # noqa: E402
+
+fake_google.install(main, latency=float(os.environ.get('BENCH_GOOGLE_LATENCY_MS', 0)) / 1000)
+app = main.app
@@ -0,0 +1,99 @@
+"""Worker cold-start benchmark: import time, first-request latency and RSS.
+
+Each run is a fresh interpreter that imports main (which builds the app), serves one
+request through the test client and reports its timings and memory, the same work a
+gunicorn worker does before it can take traffic.
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --save-baseline startup.json
+    python benchmarks/bench_startup.py --baseline startup.json --tolerance 0.2
+
+With --baseline the exit status is 1 when the median import time or RSS is worse than
+the baseline by more than the tolerance. Background workers are disabled for the runs.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter; prints one JSON line
+PROBE = r"""
+import json, resource, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+rss_import = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+response = main.app.test_client().get('/api/check_session')
+first = time.perf_counter()
+heavy = ['gspread', 'googleapiclient', 'google.oauth2', 'qrcode', 'PIL', 'openpyxl', 'psycopg2']
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (first - imported) * 1000,
+    'rss_import_mb': rss_import / 1024,
+    'rss_first_request_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'modules': len(sys.modules),
+    'heavy_modules': [m for m in heavy if m in sys.modules],
+    'status': response.status_code,
+}))
+"""
+
+METRICS = ['import_ms', 'first_request_ms', 'rss_import_mb', 'rss_first_request_mb', 'modules']
+
+
+def probe(env):
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    env = dict(os.environ, EXPIRY_SCHEDULER='0', SHEET_SYNC_WORKER='0')
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_startup.db'))
+
+    probe(env)  # warm the filesystem cache and .pyc files
+    runs = [probe(env) for _ in range(args.runs)]
+    results = {m: round(statistics.median(r[m] for r in runs), 1) for m in METRICS}
+    results['min_import_ms'] = round(min(r['import_ms'] for r in runs), 1)
+
+    print(f"{args.runs} cold starts (median):")
+    print(f"  import main        {results['import_ms']:8.1f} ms  (min {results['min_import_ms']:.1f})")
+    print(f"  first request      {results['first_request_ms']:8.1f} ms")
+    print(f"  RSS after import   {results['rss_import_mb']:8.1f} MB")
+    print(f"  RSS after request  {results['rss_first_request_mb']:8.1f} MB")
+    print(f"  modules loaded     {results['modules']:8.0f}")
+    heavy = runs[-1]['heavy_modules']
+    print(f"  integrations loaded at startup: {', '.join(heavy) if heavy else 'none'}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = []
+        for metric in ('import_ms', 'rss_import_mb', 'rss_first_request_mb'):
+            change = results[metric] / baseline[metric] - 1
+            flag = ''
+            if change > args.tolerance:
+                flag = '  REGRESSION'
+                regressions.append(metric)
+            print(f"  {metric:<22} {baseline[metric]:8.1f} -> {results[metric]:8.1f} ({change:+.0%}){flag}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_bench()
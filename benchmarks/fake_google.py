@@ -0,0 +1,119 @@
+"""In-memory stand-ins for the Google Sheets and Drive clients.
+
+install() points main.google_clients at these so benchmarks exercise the sheet outbox and
+Drive replication code paths without network access or credentials. Each call can be
+given an artificial latency to approximate the real APIs.
+"""
+import itertools
+import re
+import threading
+import time
+
+CELL_RE = re.compile(r'([A-Z]+)(\d+)')
+
+
+def _cell(ref):
+    letters, row = CELL_RE.match(ref).groups()
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - 64
+    return int(row), col
+
+
+class FakeWorksheet:
+    # Implements the handful of gspread Worksheet methods main.py uses
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.rows = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def clear(self):
+        with self._lock:
+            self._call()
+            self.rows = {}
+
+    def update(self, values, range_name='A1'):
+        self.batch_update([{'range': range_name, 'values': values}])
+
+    def col_values(self, col):
+        with self._lock:
+            self._call()
+            last = max((r for r, row in self.rows.items() if len(row) >= col and row[col - 1]), default=0)
+            return [self.rows.get(r, [])[col - 1] if len(self.rows.get(r, [])) >= col else ''
+                    for r in range(1, last + 1)]
+
+    def batch_update(self, data):
+        with self._lock:
+            self._call()
+            for item in data:
+                row, col = _cell(item['range'].split(':')[0])
+                for i, values in enumerate(item['values']):
+                    current = self.rows.setdefault(row + i, [])
+                    current.extend([''] * (col - 1 + len(values) - len(current)))
+                    current[col - 1:col - 1 + len(values)] = [str(v) for v in values]
+
+    def append_rows(self, values, table_range='A1'):
+        # Like the API, rows land after the last non-empty row, decided under the lock
+        with self._lock:
+            self._call()
+            start = max(self.rows, default=0) + 1
+            for i, row in enumerate(values):
+                self.rows[start + i] = [str(v) for v in row]
+
+    def batch_clear(self, ranges):
+        with self._lock:
+            self._call()
+            for rng in ranges:
+                row, _ = _cell(rng.split(':')[0])
+                self.rows.pop(row, None)
+
+
+class _Request:
+    def __init__(self, result, latency):
+        self.result = result
+        self.latency = latency
+
+    def execute(self, num_retries=0):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.result
+
+    def next_chunk(self, num_retries=0):
+        # Resumable uploads finish in a single chunk
+        return None, self.execute()
+
+
+class FakeDrive:
+    # Mimics service.files().create(...) and service.permissions().create(...)
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.uploads = 0
+        self._ids = itertools.count(1)
+
+    def files(self):
+        return self
+
+    def permissions(self):
+        return self
+
+    def create(self, body=None, media_body=None, fields=None, fileId=None):
+        if fileId is not None:
+            return _Request({}, self.latency)
+        self.uploads += 1
+        file_id = f"fake-{next(self._ids)}"
+        return _Request({'id': file_id, 'webViewLink': f"https://drive.example/{file_id}"}, self.latency)
+
+
+def install(main, latency=0.0):
+    """Replace main.google_clients' Sheets and Drive clients with in-memory fakes."""
+    sheet = FakeWorksheet(latency)
+    drive = FakeDrive(latency)
+    main.google_clients.master_sheet = lambda: sheet
+    main.google_clients.drive = lambda: drive
+    return sheet, drive
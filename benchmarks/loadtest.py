@@ -0,0 +1,430 @@
+"""Latency/throughput benchmark for the portal's hot endpoints.
+
+Seeds a database with synthetic tenants, then drives each scenario through the Flask test
+client (in-process, sequential) and/or a local multi-worker gunicorn (concurrent HTTP),
+with Google Sheets/Drive replaced by the in-memory fakes in fake_google.py. Reports
+p50/p95/p99 latency, throughput and peak RSS per run.
+
+    python benchmarks/loadtest.py --clients 10 --certs 100000 --db /tmp/rr_bench.db
+    python benchmarks/loadtest.py --mode gunicorn --workers 4 --concurrency 16
+    python benchmarks/loadtest.py --save-baseline benchmarks/baseline.json
+    python benchmarks/loadtest.py --baseline benchmarks/baseline.json --tolerance 0.25
+
+With --baseline the exit status is 1 when any scenario's p95, throughput or the peak RSS
+is worse than the baseline by more than the tolerance. Seeding is skipped when --db
+already holds a dataset of the requested size. Without DATABASE_URL or --db a throwaway
+SQLite file is used; the target database is wiped before seeding.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'bench-password'
+SEED_BATCH = 5000
+EQUIPMENT = ['Hose', 'Sling', 'Wire Rope', 'Crane', 'Shackle', 'Chain Block']
+# Smallest well-formed PDF, attached to every add_certificate request
+TINY_PDF = (b"%PDF-1.1\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+            b"2 0 obj<</Type/Pages/Kids[]/Count 0>>endobj\ntrailer<</Root 1 0 R>>\n%%EOF\n")
+
+
+def asset_id(tenant, i):
+    return f"T{tenant:02d}-{i:07d}"
+
+
+# --- SEEDING ---
+def seed(main, clients, certs):
+    """Wipe the database and load `clients` tenants with `certs` certificates each."""
+    from werkzeug.security import generate_password_hash
+
+    marker = f"{clients}x{certs}"
+    with main.app.app_context():
+        main.db.create_all()
+        state = main.db.session.get(main.AppState, 'bench_seed')
+        if state and state.value == marker:
+            main.refresh_notifications()  # expiry alerts are relative to today
+            print(f"Seed: reusing existing {marker} dataset")
+            return
+
+        start = time.perf_counter()
+        main.db.drop_all()
+        main.db.create_all()
+        hashed = generate_password_hash(PASSWORD, method='pbkdf2:sha256')
+        users = [main.User(username='admin', password=hashed, role='admin')]
+        users += [main.User(username=f'tenant_{t:02d}', password=hashed) for t in range(clients)]
+        main.db.session.add_all(users)
+        main.db.session.commit()
+
+        today = date.today()
+        table = main.Certificate.__table__
+        for user in users[1:]:
+            tenant = int(user.username.split('_')[1])
+            batch = []
+            for i in range(certs):
+                expiry = today + timedelta(days=i % 420 - 60)
+                batch.append({
+                    'asset_id': asset_id(tenant, i),
+                    'equipment': EQUIPMENT[i % len(EQUIPMENT)],
+                    'site': f'Site {i % 40}',
+                    'form_type': 'Form 10',
+                    'inspection_date': (expiry - timedelta(days=365)).isoformat(),
+                    'expiry_date': expiry,
+                    'status': main.status_for_expiry(expiry, today),
+                    'renewal_status': 'Not Started',
+                    'user_id': user.id,
+                })
+                if len(batch) >= SEED_BATCH:
+                    main.db.session.execute(table.insert(), batch)
+                    batch = []
+            if batch:
+                main.db.session.execute(table.insert(), batch)
+            main.db.session.commit()
+        main.db.session.add(main.AppState(key='bench_seed', value=marker))
+        main.db.session.commit()
+        main.upgrade_schema()  # search index
+        main.refresh_notifications()
+        print(f"Seed: {clients} tenants x {certs} certificates in {time.perf_counter() - start:.1f}s")
+
+
+# --- SCENARIOS ---
+class Scenario:
+    def __init__(self, name, method, path, admin=False, form=None):
+        self.name = name
+        self.method = method
+        self.path = path  # callable(rng, tenant) -> url
+        self.admin = admin
+        self.form = form  # callable(rng, n) -> form fields
+
+
+def add_certificate_form(rng, n, clients):
+    expiry = date.today() + timedelta(days=rng.randint(-30, 365))
+    return {
+        'id': f"BENCH-{os.getpid()}-{n:07d}",
+        'name': f"tenant_{rng.randrange(clients):02d}",
+        'type': rng.choice(EQUIPMENT),
+        'site': 'Bench Site',
+        'date': date.today().isoformat(),
+        'expiry_date': expiry.isoformat(),
+    }
+
+
+def build_scenarios(clients, certs):
+    # Read-only scenarios first; add_certificate invalidates the caches the others use
+    return [
+        Scenario('dashboard_stats', 'GET', lambda rng, t: '/api/dashboard_stats'),
+        Scenario('certificates', 'GET', lambda rng, t: '/api/certificates'),
+        Scenario('renewals', 'GET', lambda rng, t: '/api/renewals'),
+        Scenario('notifications', 'GET', lambda rng, t: '/api/notifications'),
+        Scenario('verify', 'GET', lambda rng, t: f"/verify/{asset_id(rng.randrange(clients), rng.randrange(certs))}"),
+        Scenario('export_csv', 'GET', lambda rng, t: '/api/export_csv'),
+        Scenario('add_certificate', 'POST', lambda rng, t: '/api/add_certificate', admin=True,
+                 form=lambda rng, n: add_certificate_form(rng, n, clients)),
+    ]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize(latencies, errors, wall):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2),
+        'rps': round(len(latencies) / wall, 1),
+    }
+
+
+# --- FLASK TEST CLIENT ---
+def run_test_client(main, scenarios, args):
+    rng = random.Random(args.seed)
+    sessions = {}
+
+    def session(user):
+        if user not in sessions:
+            client = main.app.test_client()
+            r = client.post('/api/login', json={'username': user, 'password': PASSWORD})
+            assert r.status_code == 200, f"login failed for {user}"
+            sessions[user] = client
+        return sessions[user]
+
+    # Log everyone in up front so password hashing stays out of the timings
+    for user in ['admin'] + [f'tenant_{t:02d}' for t in range(args.clients)]:
+        session(user)
+
+    results = {}
+    counter = 0
+    for sc in scenarios:
+        latencies, errors = [], 0
+        wall_start = time.perf_counter()
+        for n in range(args.requests):
+            tenant = rng.randrange(args.clients)
+            client = session('admin' if sc.admin else f'tenant_{tenant:02d}')
+            kwargs = {}
+            if sc.form:
+                counter += 1
+                data = sc.form(rng, counter)
+                data['pdf_file'] = (io.BytesIO(TINY_PDF + str(counter).encode()), 'cert.pdf')
+                kwargs = {'data': data, 'content_type': 'multipart/form-data'}
+            start = time.perf_counter()
+            r = client.open(sc.path(rng, tenant), method=sc.method, **kwargs)
+            r.get_data()
+            latencies.append(time.perf_counter() - start)
+            if r.status_code >= 400:
+                errors += 1
+        results[sc.name] = summarize(latencies, errors, time.perf_counter() - wall_start)
+        print_row('client', sc.name, results[sc.name])
+
+    main.upload_executor.shutdown(wait=True)
+    # ru_maxrss is in KiB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'scenarios': results, 'peak_rss_mb': round(peak_rss_mb, 1)}
+
+
+# --- GUNICORN ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_tree(pid):
+    # pid plus its direct children (gunicorn workers), read from /proc
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def proc_status_kb(pid, field):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler(threading.Thread):
+    """Tracks the largest combined RSS of the gunicorn master and its workers."""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            total = sum(proc_status_kb(p, 'VmRSS') for p in process_tree(self.pid))
+            self.peak_kb = max(self.peak_kb, total)
+            self.stopped.wait(self.interval)
+
+
+def start_gunicorn(args, env):
+    port = free_port()
+    cmd = [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-b', f'127.0.0.1:{port}',
+           '--log-level', 'warning', 'benchmarks.bench_app:app']
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc, base
+        except OSError:
+            if proc.poll() is not None:
+                raise SystemExit("gunicorn exited during startup")
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("gunicorn did not start within 60s")
+
+
+def run_gunicorn(scenarios, args, env):
+    import requests
+
+    proc, base = start_gunicorn(args, env)
+    sampler = RssSampler(proc.pid)
+    sampler.start()
+    counter = iter(range(1, 1 << 30))
+    counter_lock = threading.Lock()
+
+    # One logged-in session per user, shared by the client threads; logging in up front
+    # keeps password hashing out of the timings
+    sessions = {}
+    for user in ['admin'] + [f'tenant_{t:02d}' for t in range(args.clients)]:
+        s = requests.Session()
+        s.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+        s.post(base + '/api/login', json={'username': user, 'password': PASSWORD}).raise_for_status()
+        sessions[user] = s
+
+    def one_request(sc, seed):
+        rng = random.Random(seed)
+        tenant = rng.randrange(args.clients)
+        s = sessions['admin' if sc.admin else f'tenant_{tenant:02d}']
+        kwargs = {}
+        if sc.form:
+            with counter_lock:
+                n = next(counter)
+            kwargs = {'data': sc.form(rng, n),
+                      'files': {'pdf_file': ('cert.pdf', TINY_PDF + str(n).encode(), 'application/pdf')}}
+        start = time.perf_counter()
+        r = s.request(sc.method, base + sc.path(rng, tenant), **kwargs)
+        _ = r.content
+        return time.perf_counter() - start, r.status_code >= 400
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for i, sc in enumerate(scenarios):
+                seeds = [args.seed * 1_000_003 + i * args.requests + n for n in range(args.requests)]
+                wall_start = time.perf_counter()
+                outcomes = list(pool.map(lambda s, sc=sc: one_request(sc, s), seeds))
+                wall = time.perf_counter() - wall_start
+                results[sc.name] = summarize([o[0] for o in outcomes], sum(o[1] for o in outcomes), wall)
+                print_row('gunicorn', sc.name, results[sc.name])
+    finally:
+        sampler.stopped.set()
+        sampler.join()
+        proc.terminate()
+        proc.wait(timeout=30)
+    return {'scenarios': results, 'peak_rss_mb': round(sampler.peak_kb / 1024, 1),
+            'workers': args.workers, 'concurrency': args.concurrency}
+
+
+# --- REPORTING ---
+def print_row(mode, name, r):
+    print(f"  {mode:<8} {name:<16} p50 {r['p50_ms']:8.1f}ms  p95 {r['p95_ms']:8.1f}ms  "
+          f"p99 {r['p99_ms']:8.1f}ms  {r['rps']:8.1f} req/s  errors {r['errors']}")
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against a stored baseline; returns the list of regressions."""
+    regressions = []
+    for mode, run in results['runs'].items():
+        base_run = baseline.get('runs', {}).get(mode)
+        if not base_run:
+            print(f"Baseline: no {mode} run recorded, skipping")
+            continue
+        print(f"Baseline comparison ({mode}, tolerance {tolerance:.0%}):")
+        for name, r in run['scenarios'].items():
+            b = base_run['scenarios'].get(name)
+            if not b:
+                continue
+            p95_change = r['p95_ms'] / b['p95_ms'] - 1 if b['p95_ms'] else 0
+            rps_change = r['rps'] / b['rps'] - 1 if b['rps'] else 0
+            flag = ''
+            if p95_change > tolerance or rps_change < -tolerance:
+                flag = '  REGRESSION'
+                regressions.append(f"{mode}/{name}")
+            print(f"  {name:<16} p95 {b['p95_ms']:8.1f} -> {r['p95_ms']:8.1f}ms ({p95_change:+.0%})  "
+                  f"rps {b['rps']:8.1f} -> {r['rps']:8.1f} ({rps_change:+.0%}){flag}")
+        if base_run.get('peak_rss_mb'):
+            rss_change = run['peak_rss_mb'] / base_run['peak_rss_mb'] - 1
+            flag = ''
+            if rss_change > tolerance:
+                flag = '  REGRESSION'
+                regressions.append(f"{mode}/peak_rss")
+            print(f"  {'peak RSS':<16} {base_run['peak_rss_mb']:8.1f} -> {run['peak_rss_mb']:8.1f}MB "
+                  f"({rss_change:+.0%}){flag}")
+    return regressions
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=10, help='synthetic tenants to seed')
+    parser.add_argument('--certs', type=int, default=10000, help='certificates per tenant')
+    parser.add_argument('--db', help='SQLite file to seed/reuse (ignored when DATABASE_URL is set)')
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'both'], default='client')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent HTTP clients (gunicorn mode)')
+    parser.add_argument('--only', help='comma-separated scenario names to run')
+    parser.add_argument('--google-latency-ms', type=float, default=0, help='delay added to each fake Google call')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        path = os.path.abspath(args.db) if args.db else os.path.join(tempfile.mkdtemp(), 'rr_bench.db')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    os.environ['EXPIRY_SCHEDULER'] = '0'
+    # Every simulated client logs in from 127.0.0.1
+    os.environ.setdefault('LOGIN_RATE_LIMIT', '100000')
+    os.environ['BENCH_GOOGLE_LATENCY_MS'] = str(args.google_latency_ms)
+    # Keep uploads and QR files out of the working tree
+    os.environ.setdefault('PDF_STORE_DIR', tempfile.mkdtemp(prefix='rr_bench_pdfs_'))
+    os.environ.setdefault('QR_CACHE_DIR', tempfile.mkdtemp(prefix='rr_bench_qr_'))
+
+    from sqlalchemy.engine import make_url
+    from benchmarks.bench_app import main
+    seed(main, args.clients, args.certs)
+    dialect = make_url(main.app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+
+    scenarios = build_scenarios(args.clients, args.certs)
+    if args.only:
+        wanted = set(args.only.split(','))
+        scenarios = [sc for sc in scenarios if sc.name in wanted]
+
+    print(f"{dialect}: {args.clients} tenants x {args.certs} certificates, "
+          f"{args.requests} requests per scenario")
+    runs = {}
+    if args.mode in ('client', 'both'):
+        runs['client'] = run_test_client(main, scenarios, args)
+    if args.mode in ('gunicorn', 'both'):
+        runs['gunicorn'] = run_gunicorn(scenarios, args, dict(os.environ))
+    for mode, run in runs.items():
+        print(f"  {mode:<8} peak RSS {run['peak_rss_mb']:.1f} MB")
+
+    results = {
+        'dataset': {'clients': args.clients, 'certs': args.certs, 'dialect': dialect},
+        'requests_per_scenario': args.requests,
+        'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': runs,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('dataset') != results['dataset']:
+            print(f"Baseline: dataset differs ({baseline.get('dataset')}), numbers are not comparable")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,9 @@
+"""gunicorn settings, read automatically when gunicorn starts from this directory
+(`gunicorn main:app`); pass `-c gunicorn.conf.py` when starting from elsewhere."""
+
+
+def post_worker_init(worker):
+    # The background threads belong to the serving workers only; importing main (CLI
+    # commands, scripts) doesn't start them
+    import main
+    main.start_background_workers(main.app)
@@ -1,51 +1,223 @@
 import json
-import sqlite3
-from flask import Flask, render_template, request, jsonify, make_response, send_file
+from flask import Flask, Blueprint, current_app, render_template, request, jsonify, make_response, send_file, Response, stream_with_context, redirect, abort, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from sqlalchemy.exc import IntegrityError
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 import os
-from datetime import datetime
+import threading
+import time
+import uuid
+import base64
+import hashlib
+import zlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, date, timedelta
 import csv
 import io
-import qrcode
-import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
-import psycopg2
+from types import SimpleNamespace
 from dotenv import load_dotenv
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+# Google clients, qrcode/Pillow, openpyxl and the profiler are imported where they are used,
+# so a worker only loads them once a request actually needs them
 
 
 load_dotenv()
 
-app = Flask(__name__, template_folder='template')
-app.config['SECRET_KEY'] = 'RR_SOLUTIONS_SECRET_KEY'
-
-# --- DATABASE CONFIGURATION ---
-# Check if we are on Render (Cloud) or Local
-DATABASE_URL = os.environ.get('DATABASE_URL')
+# Flask's default instance folder; uploads, the PDF store and caches live under it
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
 DRIVE_FOLDER_ID = "107Y_7HUJXMWSBmlLkNrPrJS5Orogvbvz"
 
-if DATABASE_URL:
-    # Fix for SQLAlchemy: URLs must start with postgresql:// not postgres://
-    if DATABASE_URL.startswith("postgres://"):
-        DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
-else:
+
+# --- DATABASE CONFIGURATION ---
+def database_uri():
+    # Check if we are on Render (Cloud) or Local
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        # Fix for SQLAlchemy: URLs must start with postgresql:// not postgres://
+        if database_url.startswith("postgres://"):
+            database_url = database_url.replace("postgres://", "postgresql://", 1)
+        return database_url
     # Fallback to local SQLite for development
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///rr_solutions.db'
+    return 'sqlite:///rr_solutions.db'
+
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# --- CONNECTION POOL ---
+# Tuned for a hosted serverless Postgres: check connections before use and recycle them
+# before the server drops idle ones. Every value can be overridden from the environment.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 500))
 
-app.config['UPLOAD_FOLDER'] = 'static/pdfs'
-login_manager = LoginManager(app)
 
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+def engine_options(database_uri):
+    options = {
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 280)),
+    }
+    if database_uri.startswith('sqlite'):
+        # SQLite has no server to time out on; keep SQLAlchemy's default pool for it
+        return options
+
+    options.update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    )
+    return options
+
+
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 15000))
+db = SQLAlchemy()
+
+
+class DBStats:
+    # Pool and query counters fed by SQLAlchemy events, reported by /api/admin/health
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"connects": 0, "checkouts": 0, "checkins": 0, "invalidated": 0,
+                         "queries": 0, "slow_queries": 0}
+        self.recent_slow = deque(maxlen=20)
+
+    def incr(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def record_query(self, statement, elapsed_ms):
+        with self._lock:
+            self.counters["queries"] += 1
+            if elapsed_ms >= SLOW_QUERY_MS:
+                self.counters["slow_queries"] += 1
+                self.recent_slow.append({"ms": round(elapsed_ms, 1), "sql": statement[:200]})
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters, recent_slow=list(self.recent_slow))
+
+
+db_stats = DBStats()
+
+
+@event.listens_for(Pool, 'connect')
+def on_pool_connect(dbapi_conn, record):
+    db_stats.incr("connects")
+    if DB_STATEMENT_TIMEOUT_MS and type(dbapi_conn).__module__.startswith('psycopg2'):
+        # Stop runaway queries server-side instead of tying up a worker
+        cursor = dbapi_conn.cursor()
+        cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+        cursor.close()
+        dbapi_conn.commit()
+
+
+@event.listens_for(Pool, 'checkout')
+def on_pool_checkout(dbapi_conn, record, proxy):
+    db_stats.incr("checkouts")
+
+
+@event.listens_for(Pool, 'checkin')
+def on_pool_checkin(dbapi_conn, record):
+    db_stats.incr("checkins")
+
+
+@event.listens_for(Pool, 'invalidate')
+def on_pool_invalidate(dbapi_conn, record, exception):
+    db_stats.incr("invalidated")
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    elapsed = time.perf_counter() - start
+    db_stats.record_query(statement, elapsed * 1000)
+    if has_request_context() and 'db_queries' in g:
+        # Per-request totals for the instrumentation middleware
+        g.db_queries += 1
+        g.db_seconds += elapsed
+
+
+# How often the background expiry engine wakes up to check for a new day (seconds)
+EXPIRY_CHECK_INTERVAL = int(os.environ.get('EXPIRY_CHECK_INTERVAL', 300))
+# Sheet sync worker: wait this long after a change so bursts are pushed as one sync (seconds)
+SHEET_SYNC_DEBOUNCE = float(os.environ.get('SHEET_SYNC_DEBOUNCE', 5))
+# A claimed outbox batch that hasn't finished after this long is picked up again (seconds)
+SHEET_SYNC_CLAIM_TIMEOUT = int(os.environ.get('SHEET_SYNC_CLAIM_TIMEOUT', 600))
+SHEET_NAME = "RR_Solutions_Master_Data"
+# Connections kept open to Google APIs by the shared HTTP session
+GOOGLE_HTTP_POOL_SIZE = int(os.environ.get('GOOGLE_HTTP_POOL_SIZE', 10))
+# PDF uploads: written to a content-addressed store in chunks, then replicated to Drive
+# in resumable chunks by a small thread pool
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PDF_OPTIMIZE = os.environ.get('PDF_OPTIMIZE') == '1'  # needs the optional pikepdf package
+DRIVE_CHUNK_SIZE = int(os.environ.get('DRIVE_CHUNK_SIZE', 5 * 1024 * 1024))  # must be a multiple of 256 KB
+DRIVE_UPLOAD_WORKERS = int(os.environ.get('DRIVE_UPLOAD_WORKERS', 2))
+DRIVE_UPLOAD_QUEUE_LIMIT = int(os.environ.get('DRIVE_UPLOAD_QUEUE_LIMIT', 20))
+# PDFs still pending or failed are retried by the background scheduler, first after
+# PDF_RETRY_DELAY seconds and then backing off up to PDF_RETRY_MAX_DELAY, a batch per run
+PDF_RETRY_DELAY = int(os.environ.get('PDF_RETRY_DELAY', 600))
+PDF_RETRY_MAX_DELAY = int(os.environ.get('PDF_RETRY_MAX_DELAY', 6 * 3600))
+PDF_RETRY_BATCH = int(os.environ.get('PDF_RETRY_BATCH', 20))
+# Bulk import: rows per INSERT/UPDATE statement
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+# Dashboard cache: seconds an entry lives, entries kept per worker, optional shared Redis
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 60))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 2048))
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+# Public verify page: server-side cache lifetime, and how long browsers/proxies may reuse it
+VERIFY_CACHE_TTL = int(os.environ.get('VERIFY_CACHE_TTL', 300))
+VERIFY_MAX_AGE = int(os.environ.get('VERIFY_MAX_AGE', 60))
+# Instrumentation: bearer token for /metrics (admin session if unset), and the per-request
+# query count above which a request is logged as a likely N+1
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+QUERY_COUNT_WARN = int(os.environ.get('QUERY_COUNT_WARN', 50))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(INSTANCE_DIR, 'profiles'))
+# QR codes: rendered once, kept in memory and on disk; big label batches use a process pool
+QR_CACHE_DIR = os.environ.get('QR_CACHE_DIR', os.path.join(INSTANCE_DIR, 'qr_cache'))
+QR_CACHE_ENTRIES = int(os.environ.get('QR_CACHE_ENTRIES', 4096))
+QR_MAX_AGE = int(os.environ.get('QR_MAX_AGE', 30 * 24 * 3600))
+QR_RENDER_PROCESSES = int(os.environ.get('QR_RENDER_PROCESSES', os.cpu_count() or 2))
+QR_POOL_THRESHOLD = 64  # fewer uncached codes than this are rendered in-thread
+# Address the codes point at (Render sets RENDER_EXTERNAL_URL). Without one the request's
+# Host header is used, and those codes are only cached in memory
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', os.environ.get('RENDER_EXTERNAL_URL', ''))
+# Auth: how long a logged-in user is served from cache instead of the database (seconds),
+# password hashing pool size and queue limit, and login attempts allowed per IP/username
+SESSION_USER_TTL = int(os.environ.get('SESSION_USER_TTL', 30))
+# Every gunicorn worker has its own hashing pool, so each defaults to a quarter of the cores
+# to leave room for regular requests during a login storm
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 1) // 4)))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', 32))
+LOGIN_RATE_LIMIT = int(os.environ.get('LOGIN_RATE_LIMIT', 20))
+LOGIN_RATE_WINDOW = int(os.environ.get('LOGIN_RATE_WINDOW', 60))
+# Reverse proxies in front of the app whose X-Forwarded-For/-Proto are trusted (Render runs
+# one); the client address they report is what the per-IP login limit counts
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1 if os.environ.get('RENDER') else 0))
+# add_certificate: how long Idempotency-Key responses are kept, and compare-and-set attempts
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+UPSERT_RETRIES = 5
+# Expiry notifications: look-ahead window (days), how long old ones are kept (days), and the
+# SMTP server for the daily email digest (digests are only logged when SMTP_HOST is unset)
+NOTIFY_WINDOW_DAYS = int(os.environ.get('NOTIFY_WINDOW_DAYS', 7))
+NOTIFY_RETENTION_DAYS = int(os.environ.get('NOTIFY_RETENTION_DAYS', 30))
+SMTP_HOST = os.environ.get('SMTP_HOST')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USER = os.environ.get('SMTP_USER')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_FROM = os.environ.get('SMTP_FROM', 'alerts@rrsolutions.example')
+SMTP_MESSAGES_PER_CONNECTION = int(os.environ.get('SMTP_MESSAGES_PER_CONNECTION', 100))
+SHEET_HEADERS = ["Username", "Asset ID", "Equipment", "Site", "Inspection Date", "Expiry Date", "Status", "Renewal Stage" ,"Has PDF?"]
+
+login_manager = LoginManager()
+# Every route, hook and CLI command is registered on this blueprint; create_app() builds the app
+portal = Blueprint('portal', __name__, cli_group=None)
 
 # --- DATABASE MODELS ---
 class User(UserMixin, db.Model):
@@ -53,8 +225,13 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), nullable=True)
     password = db.Column(db.String(120), nullable=False)
+    role = db.Column(db.String(20), nullable=False, default='client', server_default='client')  # 'admin' or 'client'
     certs = db.relationship('Certificate', backref='owner', lazy=True)
 
+    @property
+    def is_admin(self):
+        return self.role == 'admin'
+
 
 class Certificate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -63,82 +240,853 @@ class Certificate(db.Model):
     equipment = db.Column(db.String(100))
     site = db.Column(db.String(100))
     inspection_date = db.Column(db.String(20))
-    expiry_date = db.Column(db.String(20))
+    expiry_date = db.Column(db.Date, index=True)
     status = db.Column(db.String(20), default="Valid")
     pdf_path = db.Column(db.String(200))
+    pdf_status = db.Column(db.String(20))  # None, "pending", "ready" or "failed" for Drive replication
+    pdf_sha256 = db.Column(db.String(64), index=True)  # PdfBlob in the local store, if any
     renewal_status = db.Column(db.String(50), default="Not Started")
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Bumped on every UPDATE (including bulk ones); used as the verify page's version
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Bumped whenever add_certificate or an import rewrites the inspection; add_certificate
+    # compare-and-sets on it (see upsert_certificate)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    # Per-tenant indexes backing the paginated inventory's sort keys and filters
+    __table_args__ = (
+        db.Index('ix_certificate_user_expiry', 'user_id', 'expiry_date', 'id'),
+        db.Index('ix_certificate_user_asset', 'user_id', 'asset_id', 'id'),
+        db.Index('ix_certificate_user_site', 'user_id', 'site', 'id'),
+        db.Index('ix_certificate_user_equipment', 'user_id', 'equipment', 'id'),
+        db.Index('ix_certificate_user_status', 'user_id', 'status'),
+    )
+
+
+class PdfBlob(db.Model):
+    # One row per distinct PDF in the content-addressed store, shared by every certificate using it
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    drive_link = db.Column(db.String(200))
+    drive_status = db.Column(db.String(20), default="pending")  # "pending", "ready" or "failed"
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Background retries of the Drive copy (see retry_pdf_replication)
+    drive_attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime)
+
+
+class SyncJob(db.Model):
+    # Outbox of assets whose Google Sheet row needs refreshing, written in the same
+    # transaction as the change so nothing is lost if the worker is down
+    id = db.Column(db.Integer, primary_key=True)
+    asset_id = db.Column(db.String(50), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(36), index=True)
+    claimed_at = db.Column(db.DateTime)
+
+
+class AppState(db.Model):
+    # Small key/value table for bookkeeping shared by all workers (e.g. last expiry run)
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.String(200))
+
 
-with app.app_context():
+class Notification(db.Model):
+    # One row per certificate expiry and alert kind ("week", then "tomorrow"), written by
+    # the daily notification run
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    asset_id = db.Column(db.String(50), nullable=False)
+    expiry_date = db.Column(db.Date, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    read_at = db.Column(db.DateTime)
+    emailed_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint('asset_id', 'expiry_date', 'kind', name='uq_notification_asset_expiry_kind'),
+        db.Index('ix_notification_user_expiry', 'user_id', 'expiry_date'),
+        db.Index('ix_notification_unsent', 'emailed_at', 'user_id'),
+    )
+
+
+class IdempotencyKey(db.Model):
+    # Response of a request sent with an Idempotency-Key header, replayed when the client
+    # retries it; stored in the same transaction as the write it describes
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    key = db.Column(db.String(100), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class CertificateRollup(db.Model):
+    # Certificate counts per client and bucket of one dimension (site, equipment, expiry
+    # month, ...), kept current by every certificate write; see ANALYTICS ROLLUPS
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    dimension = db.Column(db.String(20), primary_key=True)
+    bucket = db.Column(db.String(100), primary_key=True)  # '' for certificates with no value
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+
+def upgrade_schema():
+    # db.create_all() never alters existing tables, so bring older databases up to date here
+    inspector = inspect(db.engine)
+    user_cols = [c['name'] for c in inspector.get_columns('user')]
+    cert_cols = {c['name']: c for c in inspector.get_columns('certificate')}
+    blob_cols = [c['name'] for c in inspector.get_columns('pdf_blob')]
+
+    with db.engine.begin() as conn:
+        if 'email' not in user_cols:
+            conn.execute(text('ALTER TABLE "user" ADD COLUMN email VARCHAR(120)'))
+        if 'role' not in user_cols:
+            conn.execute(text('ALTER TABLE "user" ADD COLUMN role VARCHAR(20) NOT NULL DEFAULT \'client\''))
+            # Admin rights used to come from the username
+            conn.execute(text('UPDATE "user" SET role = \'admin\' WHERE username = \'admin\''))
+        if 'pdf_status' not in cert_cols:
+            conn.execute(text('ALTER TABLE certificate ADD COLUMN pdf_status VARCHAR(20)'))
+        if 'pdf_sha256' not in cert_cols:
+            conn.execute(text('ALTER TABLE certificate ADD COLUMN pdf_sha256 VARCHAR(64)'))
+        if 'updated_at' not in cert_cols:
+            conn.execute(text('ALTER TABLE certificate ADD COLUMN updated_at TIMESTAMP'))
+        if 'version' not in cert_cols:
+            conn.execute(text('ALTER TABLE certificate ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+        if 'drive_attempts' not in blob_cols:
+            conn.execute(text('ALTER TABLE pdf_blob ADD COLUMN drive_attempts INTEGER NOT NULL DEFAULT 0'))
+        if 'next_attempt_at' not in blob_cols:
+            conn.execute(text('ALTER TABLE pdf_blob ADD COLUMN next_attempt_at TIMESTAMP'))
+
+        # expiry_date used to be free text. SQLite reads a DATE column from the same text, so
+        # there every value must be 'YYYY-MM-DD'; PostgreSQL converts the column to a real DATE.
+        legacy_text = 'DATE' not in str(cert_cols['expiry_date']['type']).upper()
+        fixed_dates = 0
+        if db.engine.dialect.name == 'sqlite' or legacy_text:
+            fixed_dates = normalize_expiry_text(conn)
+        if db.engine.dialect.name == 'postgresql' and legacy_text:
+            conn.execute(text("ALTER TABLE certificate ALTER COLUMN expiry_date TYPE DATE "
+                              "USING expiry_date::date"))
+
+    # Indexes added to the models after the table was first created
+    for index in Certificate.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    create_search_index()
+
+    # Databases from before the rollups existed get them computed once (and again when
+    # expiry dates were rewritten above, since they move between expiry-month buckets)
+    if fixed_dates or (not db.session.query(CertificateRollup.user_id).first()
+                       and db.session.query(Certificate.id).first()):
+        rebuild_rollups()
+
+
+# Formats found in old expiry_date text; the sheet once used US dates ('2/19/2026')
+LEGACY_DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%Y/%m/%d')
+
+
+def parse_legacy_date(value):
+    if isinstance(value, str):
+        value = value.strip()
+        if len(value) > 10 and value[10] in 'T ':
+            value = value[:10]  # a datetime written where a date belongs
+        for fmt in LEGACY_DATE_FORMATS:
+            try:
+                return datetime.strptime(value, fmt).date()
+            except ValueError:
+                pass
+    return None
+
+
+def normalize_expiry_text(conn):
+    """Rewrite stored expiry_date text as 'YYYY-MM-DD', and values no format matches
+    ('', 'N/A', ...) as NULL. Returns the number of rows changed."""
+    fixed = []
+    for row_id, value in conn.execute(text("SELECT id, expiry_date FROM certificate WHERE expiry_date IS NOT NULL")):
+        parsed = parse_legacy_date(value)
+        iso = parsed.isoformat() if parsed else None
+        if iso != value:
+            if iso is None:
+                print(f"Unreadable expiry date {value!r} on certificate {row_id} cleared")
+            fixed.append({"id": row_id, "expiry": iso})
+    if fixed:
+        conn.execute(text("UPDATE certificate SET expiry_date = :expiry WHERE id = :id"), fixed)
+    return len(fixed)
+
+
+def create_search_index():
+    """Indexes behind /api/search.
+
+    Both dialects get a (user_id, lower(asset_id)) index. For substring matches PostgreSQL
+    gets pg_trgm GIN indexes on the lower-cased columns and SQLite an FTS5 trigram table
+    kept in step with certificate by triggers; without them search walks the tenant's rows.
+    """
+    dialect = db.engine.dialect.name
+    try:
+        with db.engine.begin() as conn:
+            # Ordered, case-insensitive walk of one tenant's assets (prefix matches, common terms)
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_certificate_user_asset_lower '
+                              'ON certificate (user_id, lower(asset_id))'))
+            if dialect == 'postgresql':
+                conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+                for column in SEARCH_COLUMNS:
+                    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_certificate_{column}_trgm '
+                                      f'ON certificate USING gin (lower({column}) gin_trgm_ops)'))
+            elif dialect == 'sqlite':
+                triggers_missing = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'certificate_fts_ai'")).first() is None
+                conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS certificate_fts USING fts5("
+                                  "asset_id, equipment, site, content='certificate', content_rowid='id', "
+                                  "tokenize='trigram')"))
+                old = "INSERT INTO certificate_fts(certificate_fts, rowid, asset_id, equipment, site) " \
+                      "VALUES ('delete', old.id, old.asset_id, old.equipment, old.site);"
+                new = "INSERT INTO certificate_fts(rowid, asset_id, equipment, site) " \
+                      "VALUES (new.id, new.asset_id, new.equipment, new.site);"
+                conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS certificate_fts_ai AFTER INSERT ON certificate BEGIN {new} END"))
+                conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS certificate_fts_ad AFTER DELETE ON certificate BEGIN {old} END"))
+                conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS certificate_fts_au AFTER UPDATE OF asset_id, equipment, site "
+                                  f"ON certificate BEGIN {old} {new} END"))
+                if triggers_missing:
+                    # New index (or the certificate table was recreated): index the existing rows
+                    conn.execute(text("INSERT INTO certificate_fts(certificate_fts) VALUES ('rebuild')"))
+    except Exception as e:
+        print(f"Search Index Skipped: {e}")
+    search_backends.pop(str(db.engine.url), None)
+
+
+@portal.cli.command('init-db')
+def init_db_command():
+    """Create tables, apply upgrade_schema() and seed the admin account (run once per deploy)."""
     db.create_all()
+    upgrade_schema()
     # Admin Seeder
     if not User.query.filter_by(username='admin').first():
         hashed_pw = generate_password_hash('admin123', method='pbkdf2:sha256')
-        db.session.add(User(username='admin', password=hashed_pw, email="nitish.pkv@gmail.com"))
+        db.session.add(User(username='admin', password=hashed_pw, email="nitish.pkv@gmail.com", role='admin'))
         db.session.commit()
+    print("Database ready.")
 
 
-def upload_pdf_to_drive(file_obj, filename):
+# --- GOOGLE API CLIENTS ---
+class CallMetrics:
+    # Thread-safe call counters and latency totals, keyed by call name
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            stat = self._stats.setdefault(name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stat["calls"] += 1
+            stat["total_ms"] += seconds * 1000
+            stat["max_ms"] = max(stat["max_ms"], seconds * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {
+                    "calls": stat["calls"],
+                    "total_ms": round(stat["total_ms"], 2),
+                    "avg_ms": round(stat["total_ms"] / stat["calls"], 2),
+                    "max_ms": round(stat["max_ms"], 2),
+                }
+                for name, stat in self._stats.items()
+            }
+
+
+api_metrics = CallMetrics()
+
+
+class GoogleClients:
+    """Process-wide registry of Google credentials and API clients.
+
+    Everything is built lazily on first use and then reused. Credentials refresh their own
+    token when it expires. The gspread client shares one pooled HTTP session; the Drive
+    service is kept per thread because httplib2 connections are not thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._creds = None
+        self._gspread = None
+        self._sheet = None
+
+    def credentials(self):
+        if self._creds is None:
+            with self._lock:
+                if self._creds is None:
+                    with api_metrics.timed('setup.credentials'):
+                        self._creds = get_google_creds()
+        return self._creds
+
+    def session(self):
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+
+        # One pooled session that signs (and refreshes) every request
+        session = AuthorizedSession(self.credentials())
+        adapter = HTTPAdapter(pool_connections=GOOGLE_HTTP_POOL_SIZE, pool_maxsize=GOOGLE_HTTP_POOL_SIZE)
+        session.mount('https://', adapter)
+        return session
+
+    def gspread(self):
+        import gspread
+
+        if self._gspread is None:
+            with self._lock:
+                if self._gspread is None:
+                    with api_metrics.timed('setup.gspread'):
+                        self._gspread = gspread.authorize(self.credentials(), session=self.session())
+        return self._gspread
+
+    def master_sheet(self):
+        if self._sheet is None:
+            client = self.gspread()
+            with self._lock:
+                if self._sheet is None:
+                    with api_metrics.timed('sheets.open'):
+                        self._sheet = client.open(SHEET_NAME).sheet1
+        return self._sheet
+
+    def drive(self):
+        service = getattr(self._local, 'drive', None)
+        if service is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            from googleapiclient.discovery import build
+
+            with api_metrics.timed('setup.drive'):
+                http = AuthorizedHttp(self.credentials(), http=httplib2.Http())
+                service = build('drive', 'v3', http=http, cache_discovery=False)
+            self._local.drive = service
+        return service
+
+    def reset(self):
+        # Drop every cached client (e.g. after rotating GOOGLE_CREDENTIALS)
+        with self._lock:
+            self._creds = None
+            self._gspread = None
+            self._sheet = None
+            self._local = threading.local()
+
+
+google_clients = GoogleClients()
+
+
+# Bounded pool for Drive uploads; the semaphore caps how many can be queued at once
+upload_executor = ThreadPoolExecutor(max_workers=DRIVE_UPLOAD_WORKERS, thread_name_prefix='drive-upload')
+upload_slots = threading.BoundedSemaphore(DRIVE_UPLOAD_QUEUE_LIMIT)
+
+
+# --- PDF STORE ---
+def pdf_store_path(sha256):
+    return os.path.join(current_app.config['PDF_STORE_DIR'], sha256[:2], sha256)
+
+
+def store_pdf(file_obj):
+    """Write an upload into the content-addressed store, hashing it as it streams in.
+
+    Returns (blob, is_new). Identical files are kept once; the PdfBlob is added to the
+    session but not committed.
+    """
+    os.makedirs(current_app.config['PDF_STORE_DIR'], exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=current_app.config['PDF_STORE_DIR'], prefix='.upload-')
+    with os.fdopen(fd, 'wb') as out:
+        while True:
+            chunk = file_obj.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+
+    sha256 = digest.hexdigest()
+    path = pdf_store_path(sha256)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    blob = db.session.get(PdfBlob, sha256)
+    if blob:
+        return blob, False
+    # The upload pool gets the first try; the scheduler only steps in if that doesn't finish
+    blob = PdfBlob(sha256=sha256, size=size, content_type=file_obj.mimetype or 'application/pdf',
+                   next_attempt_at=datetime.utcnow() + timedelta(seconds=PDF_RETRY_DELAY))
     try:
-        creds = get_google_creds()
-        service = build('drive', 'v3', credentials=creds)
+        with db.session.begin_nested():
+            db.session.add(blob)
+    except IntegrityError:
+        # Another worker stored the same file at the same moment
+        return db.session.get(PdfBlob, sha256), False
+    return blob, True
+
+
+def attach_pdf(cert, file_obj):
+    # Point the certificate at the stored file; returns the blob if it still needs replicating
+    blob, is_new = store_pdf(file_obj)
+    cert.pdf_sha256 = blob.sha256
+    cert.pdf_path = f"/pdfs/{blob.sha256}"
+    cert.pdf_status = blob.drive_status
+    if is_new or blob.drive_status == "failed":
+        return blob
+    return None
+
+
+def pdf_url(path):
+    # pdf_path holds a store URL, a Drive link, or (for older rows) a file name in static/pdfs
+    if not path or path.startswith(('/', 'http://', 'https://')):
+        return path or None
+    return f"/static/pdfs/{path}"
+
+
+def optimized_copy(path):
+    # Compressed, linearized copy for Drive when PDF_OPTIMIZE is on and pikepdf is installed
+    if not PDF_OPTIMIZE:
+        return None
+    try:
+        import pikepdf
+        fd, out_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        with pikepdf.open(path) as pdf:
+            pdf.save(out_path, linearize=True, compress_streams=True,
+                     object_stream_mode=pikepdf.ObjectStreamMode.generate)
+        return out_path
+    except Exception as e:
+        print(f"PDF Optimize Skipped: {e}")
+        return None
 
-        file_metadata = {'name': filename, 'parents': [DRIVE_FOLDER_ID]}
 
-        # We need to convert the Flask file object to a BytesIO stream
-        # This ensures the upload works on cloud servers like Render
-        file_stream = io.BytesIO(file_obj.read())
+def replicate_pdf(sha256, filename):
+    """Copy one stored PDF to the Drive folder and record the outcome on its certificates."""
+    path = pdf_store_path(sha256)
+    optimized = optimized_copy(path)
+    try:
+        drive_link = upload_pdf_to_drive(optimized or path, filename)
+    finally:
+        if optimized:
+            os.remove(optimized)
+
+    blob = db.session.get(PdfBlob, sha256)
+    blob.drive_link = drive_link
+    blob.drive_status = "ready" if drive_link else "failed"
+    Certificate.query.filter_by(pdf_sha256=sha256).update(
+        {Certificate.pdf_status: blob.drive_status}, synchronize_session=False)
+    db.session.commit()
+    return drive_link
 
-        media = MediaIoBaseUpload(file_stream, mimetype='application/pdf', resumable=True)
 
-        file = service.files().create(
+def replicate_and_release(app, sha256, filename):
+    try:
+        with app.app_context():
+            replicate_pdf(sha256, filename)
+    finally:
+        upload_slots.release()
+
+
+def queue_replication(blob, filename):
+    # Files stay servable from the local store, so a full queue just leaves the blob pending
+    # for the scheduler's retry (or `flask replicate-pdfs`) instead of failing the request
+    if not upload_slots.acquire(blocking=False):
+        print(f"Drive Replication: queue full, {blob.sha256} left pending")
+        return
+    upload_executor.submit(replicate_and_release, current_app._get_current_object(), blob.sha256, filename)
+
+
+def retry_pdf_replication(now=None):
+    """Retry the Drive copy of PDFs left pending (queue full, worker restarted) or failed.
+
+    The local store doesn't survive a redeploy on Render, so until the copy succeeds it is
+    the only one. Each blob is claimed with a compare-and-set on drive_attempts that also
+    pushes next_attempt_at back (doubling per attempt), so workers never upload the same
+    file at once and a failing one is retried less and less often. Returns the number tried.
+    """
+    now = now or datetime.utcnow()
+    due = PdfBlob.query.filter(PdfBlob.drive_status != "ready",
+                               db.or_(PdfBlob.next_attempt_at.is_(None), PdfBlob.next_attempt_at <= now)) \
+        .order_by(PdfBlob.next_attempt_at).limit(PDF_RETRY_BATCH).all()
+    tried = 0
+    for blob in due:
+        delay = min(PDF_RETRY_DELAY * 2 ** blob.drive_attempts, PDF_RETRY_MAX_DELAY)
+        claimed = PdfBlob.query.filter(PdfBlob.sha256 == blob.sha256,
+                                       PdfBlob.drive_attempts == blob.drive_attempts).update(
+            {PdfBlob.drive_attempts: blob.drive_attempts + 1,
+             PdfBlob.next_attempt_at: now + timedelta(seconds=delay)}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            continue  # another worker took it
+        if not os.path.exists(pdf_store_path(blob.sha256)):
+            print(f"Drive Replication: {blob.sha256} is missing from the local store")
+            continue
+        asset_id = db.session.query(Certificate.asset_id).filter_by(pdf_sha256=blob.sha256).limit(1).scalar()
+        tried += 1
+        if not replicate_pdf(blob.sha256, f"{asset_id or blob.sha256[:16]}.pdf"):
+            print(f"Drive Replication: {blob.sha256} failed again, next try in {delay}s")
+    return tried
+
+
+@portal.cli.command('replicate-pdfs')
+def replicate_pdfs_command():
+    """Send every stored PDF that is pending or failed to Google Drive."""
+    blobs = PdfBlob.query.filter(PdfBlob.drive_status != "ready").all()
+    for blob in blobs:
+        replicate_pdf(blob.sha256, f"{blob.sha256[:16]}.pdf")
+    print(f"{len(blobs)} PDFs replicated.")
+
+
+def upload_pdf_to_drive(path, filename):
+    from googleapiclient.http import MediaFileUpload
+
+    try:
+        service = google_clients.drive()
+
+        file_metadata = {'name': filename, 'parents': [DRIVE_FOLDER_ID]}
+
+        # Resumable upload straight from the stored file, one chunk in memory at a time
+        media = MediaFileUpload(path, mimetype='application/pdf', chunksize=DRIVE_CHUNK_SIZE, resumable=True)
+        upload = service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id, webViewLink'
-        ).execute()
+        )
+
+        file = None
+        with api_metrics.timed('drive.files.create'):
+            while file is None:
+                _, file = upload.next_chunk(num_retries=3)
 
         # Permissions: Make it viewable by your clients
-        service.permissions().create(
-            fileId=file.get('id'),
-            body={'type': 'anyone', 'role': 'viewer'}
-        ).execute()
+        with api_metrics.timed('drive.permissions.create'):
+            service.permissions().create(
+                fileId=file.get('id'),
+                body={'type': 'anyone', 'role': 'viewer'}
+            ).execute()
 
         return file.get('webViewLink')
     except Exception as e:
         print(f"Drive Upload Error: {e}")
         return None
 
-def update_all_statuses():
-    with app.app_context():
-        today = datetime.now()
-        certs = Certificate.query.all()
 
-        updated_count = 0
-        for c in certs:
+def parse_date(value):
+    # Dates come from the HTML date inputs as 'YYYY-MM-DD'
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value).strip(), '%Y-%m-%d').date()
+
+
+def format_date(value):
+    return value.isoformat() if value else None
+
+
+def status_for_expiry(expiry_date, today=None):
+    # A certificate stops being valid on its expiry date
+    today = today or date.today()
+    if expiry_date and expiry_date <= today:
+        return "Expired"
+    return "Valid"
+
+
+def run_expiry_transitions(today=None):
+    """Flip certificates whose expiry date passed since the last run to 'Expired'.
+
+    Only the rows expiring between the previous run and today are touched, using one
+    range UPDATE on the indexed expiry_date column. Returns the number of rows changed.
+    """
+    today = today or date.today()
+    state = db.session.get(AppState, 'expiry_last_run')
+    last_run = parse_date(state.value) if state else None
+
+    if last_run and last_run >= today:
+        return 0
+    # Every worker's scheduler gets here at midnight; the claim (committed together with the
+    # updates below) lets exactly one of them run, so the rollup deltas are applied once
+    if not claim_state('expiry_last_run', state.value if state else None, today.isoformat()):
+        db.session.rollback()
+        return 0
+
+    query = Certificate.query.filter(Certificate.expiry_date <= today, Certificate.status != "Expired")
+    if last_run:
+        query = query.filter(Certificate.expiry_date > last_run)
+    deltas = Counter()
+    rows = query.with_entities(Certificate.asset_id, Certificate.user_id, Certificate.status).all()
+    for r in rows:
+        move_rollup(deltas, r.user_id, 'status', r.status, "Expired")
+    changed = [r.asset_id for r in rows]
+    updated_count = query.update({Certificate.status: "Expired"}, synchronize_session=False)
+
+    if not last_run:
+        # First run on this database: also reconcile rows that were renewed into the future
+        renewed = Certificate.query.filter(Certificate.expiry_date > today, Certificate.status == "Expired")
+        rows = renewed.with_entities(Certificate.asset_id, Certificate.user_id).all()
+        for r in rows:
+            move_rollup(deltas, r.user_id, 'status', "Expired", "Valid")
+        changed += [r.asset_id for r in rows]
+        updated_count += renewed.update({Certificate.status: "Valid"}, synchronize_session=False)
+    apply_rollup_deltas(deltas)
+
+    # The sheet shows the status column too, so push the flipped rows
+    queue_sheet_sync(*changed)
+    db.session.commit()
+
+    if updated_count > 0:
+        dashboard_cache.clear()
+        verify_cache.clear()
+        print(f"Expiry Engine: {updated_count} statuses updated for {today}.")
+    return updated_count
+
+
+def expiry_scheduler_loop(app):
+    # Runs in a daemon thread; the AppState guard makes it safe for every worker to run one
+    while True:
+        try:
+            with app.app_context():
+                run_expiry_transitions()
+                run_notification_digest()
+                prune_idempotency_keys()
+                retry_pdf_replication()
+        except Exception as e:
+            print(f"Expiry Engine Error: {e}")
+        time.sleep(EXPIRY_CHECK_INTERVAL)
+
+
+def start_expiry_scheduler(app):
+    thread = threading.Thread(target=expiry_scheduler_loop, args=(app,), name='expiry-scheduler', daemon=True)
+    thread.start()
+    return thread
+
+
+def claim_state(key, expected, value):
+    """Compare-and-set AppState[key] from `expected` (None: no row yet) to `value`.
+
+    Not committed: the row stays locked until the caller commits, so a concurrent claimer
+    waits and then finds the value changed. True if this caller won.
+    """
+    if expected is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(AppState(key=key, value=value))
+            return True
+        except IntegrityError:
+            return False
+    return AppState.query.filter(AppState.key == key, AppState.value == expected).update(
+        {AppState.value: value}, synchronize_session=False) == 1
+
+
+def claim_daily_run(key, today):
+    """True for exactly one caller per day across all workers (compare-and-set on AppState)."""
+    state = db.session.get(AppState, key)
+    if state and state.value >= today.isoformat():
+        return False
+    claimed = claim_state(key, state.value if state else None, today.isoformat())
+    db.session.commit()
+    return claimed
+
+
+@portal.cli.command('expire-certificates')
+def expire_certificates_command():
+    """Run the expiry transition once (for cron jobs)."""
+    count = run_expiry_transitions()
+    print(f"{count} certificates updated.")
+
+
+# --- NOTIFICATIONS ---
+def notification_kind(expiry_date, today):
+    return "tomorrow" if (expiry_date - today).days <= 1 else "week"
+
+
+def refresh_notifications(today=None, asset_ids=None):
+    """Materialize alerts for certificates expiring within NOTIFY_WINDOW_DAYS.
+
+    One range query on the expiry_date index across every tenant (or just `asset_ids`);
+    rows that already exist are left alone, so this is safe to re-run. Returns the number
+    of notifications created.
+    """
+    today = today or date.today()
+    query = db.session.query(Certificate.user_id, Certificate.asset_id, Certificate.expiry_date).filter(
+        Certificate.expiry_date > today,
+        Certificate.expiry_date <= today + timedelta(days=NOTIFY_WINDOW_DAYS))
+    if asset_ids is not None:
+        query = query.filter(Certificate.asset_id.in_(asset_ids))
+    due = {(r.asset_id, r.expiry_date, notification_kind(r.expiry_date, today)): r.user_id for r in query}
+    if not due:
+        return 0
+
+    existing = db.session.query(Notification.asset_id, Notification.expiry_date, Notification.kind).filter(
+        Notification.expiry_date > today,
+        Notification.expiry_date <= today + timedelta(days=NOTIFY_WINDOW_DAYS))
+    if asset_ids is not None:
+        existing = existing.filter(Notification.asset_id.in_(asset_ids))
+    missing = set(due) - {tuple(r) for r in existing}
+    created = 0
+    if missing:
+        now = datetime.utcnow()
+        rows = [{"user_id": due[key], "asset_id": key[0], "expiry_date": key[1], "kind": key[2], "created_at": now}
+                for key in missing]
+        # A concurrent refresh (another upload, the daily run) may insert the same alerts
+        # between the read above and this insert; those rows are skipped, not an error
+        table = Notification.__table__
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            stmt = upsert_insert(dialect, table).on_conflict_do_nothing(
+                index_elements=[table.c.asset_id, table.c.expiry_date, table.c.kind])
+            created = db.session.execute(stmt, rows).rowcount
+        else:
+            created = sum(insert_if_absent(table, row, ['asset_id', 'expiry_date', 'kind']) is not None
+                          for row in rows)
+    db.session.commit()
+    return created
+
+
+def digest_text(username, rows, today):
+    lines = [f"Hello {username},", "", "These certificates are due for re-inspection soon:", ""]
+    for r in rows:
+        days = (r.expiry_date - today).days
+        when = "tomorrow" if days == 1 else f"in {days} days"
+        lines.append(f"  - {r.asset_id}: expires {when} ({format_date(r.expiry_date)})")
+    lines += ["", "Reply to this email or use the portal to request a re-test.", "", "RR Solutions"]
+    return "\n".join(lines)
+
+
+class SMTPSender:
+    """Sends a batch of messages over one SMTP connection, reconnecting every
+    SMTP_MESSAGES_PER_CONNECTION messages or when the server drops the connection.
+
+    For local testing run `python -m aiosmtpd -n -l localhost:1025` (pip install aiosmtpd)
+    and set SMTP_HOST=localhost SMTP_PORT=1025 SMTP_STARTTLS=0.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.sent_on_conn = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        import smtplib
+
+        self.conn = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        if SMTP_STARTTLS:
+            self.conn.starttls()
+        if SMTP_USER:
+            self.conn.login(SMTP_USER, SMTP_PASSWORD)
+        self.sent_on_conn = 0
+
+    def close(self):
+        if self.conn is not None:
             try:
-                # IMPORTANT: Ensure your format matches how you saved it.
-                # If you saved as 2026-02-19, use '%Y-%m-%d'
-                # If you saved as 2/19/2026, use '%m/%d/%Y'
-                expiry = datetime.strptime(c.expiry_date, '%Y-%m-%d')
-
-                # If today is past the expiry date
-                if expiry < today:
-                    if c.status != "Expired":
-                        c.status = "Expired"
-                        updated_count += 1
-                else:
-                    if c.status != "Valid":
-                        c.status = "Valid"
-                        updated_count += 1
-            except Exception as e:
-                print(f"Error updating status for {c.asset_id}: {e}")
+                self.conn.quit()
+            except Exception:
+                pass
+            self.conn = None
 
-        if updated_count > 0:
+    def send(self, message):
+        import smtplib
+
+        if self.conn is None or self.sent_on_conn >= SMTP_MESSAGES_PER_CONNECTION:
+            self.close()
+            self.connect()
+        try:
+            self.conn.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            self.connect()
+            self.conn.send_message(message)
+        self.sent_on_conn += 1
+
+
+def notification_is_live():
+    # Join condition: the alert's certificate still has the owner and expiry it was written for
+    return db.and_(Certificate.asset_id == Notification.asset_id,
+                   Certificate.expiry_date == Notification.expiry_date,
+                   Certificate.user_id == Notification.user_id)
+
+
+def send_notification_digests(today=None):
+    """Email each user one digest of their notifications that haven't been emailed yet."""
+    from email.message import EmailMessage
+
+    today = today or date.today()
+    # Alerts whose certificate was renewed, reassigned or deleted are never shown, so don't mail them
+    Notification.query.filter(Notification.emailed_at.is_(None), ~db.exists().where(notification_is_live())).delete(
+        synchronize_session=False)
+    rows = db.session.query(Notification.id, Notification.user_id, Notification.asset_id,
+                            Notification.expiry_date, User.username, User.email).join(
+        User, Notification.user_id == User.id).join(Certificate, notification_is_live()).filter(
+        Notification.emailed_at.is_(None), Notification.expiry_date > today).order_by(
+        Notification.user_id, Notification.expiry_date, Notification.asset_id).all()
+
+    by_user = {}
+    for r in rows:
+        by_user.setdefault(r.user_id, []).append(r)
+
+    sent = 0
+    with SMTPSender() as sender:
+        for user_rows in by_user.values():
+            first = user_rows[0]
+            if first.email and SMTP_HOST:
+                message = EmailMessage()
+                message['Subject'] = f"RR Solutions: {len(user_rows)} certificate(s) expiring soon"
+                message['From'] = SMTP_FROM
+                message['To'] = first.email
+                message.set_content(digest_text(first.username, user_rows, today))
+                try:
+                    sender.send(message)
+                except Exception as e:
+                    # Left unsent; the next run tries again
+                    print(f"Notification Email Error ({first.username}): {e}")
+                    continue
+                sent += 1
+            elif first.email:
+                print(f"Notification Digest: {len(user_rows)} alerts for {first.email} (SMTP_HOST not set)")
+            # Users without an email still see the alerts in the portal
+            Notification.query.filter(Notification.id.in_([r.id for r in user_rows])).update(
+                {Notification.emailed_at: datetime.utcnow()}, synchronize_session=False)
             db.session.commit()
-            print(f"Database Sync: {updated_count} statuses updated to reflect current date.")
+    return sent
+
+
+def run_notification_digest(today=None, force=False):
+    """The daily notification run: materialize alerts, email digests, prune old rows."""
+    today = today or date.today()
+    if not force and not claim_daily_run('notify_last_run', today):
+        return None
+    created = refresh_notifications(today)
+    sent = send_notification_digests(today)
+    Notification.query.filter(
+        Notification.expiry_date < today - timedelta(days=NOTIFY_RETENTION_DAYS)).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"Notification Digest: {created} new alerts, {sent} emails sent for {today}.")
+    return {"created": created, "emailed": sent}
+
+
+@portal.cli.command('send-digests')
+def send_digests_command():
+    """Run today's notification digest now, even if it already ran (for cron jobs or testing)."""
+    print(run_notification_digest(force=True))
 
 
 def get_google_creds():
+    from google.oauth2.service_account import Credentials
+
     # 1. Check if we are on Render (looking for a Secret Environment Variable)
     creds_json = os.environ.get('GOOGLE_CREDENTIALS')
 
@@ -156,81 +1104,669 @@ def get_google_creds():
             scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
         )
 
-def sync_to_google_sheets():
+def get_master_sheet():
+    return google_clients.master_sheet()
+
+
+def sheet_rows_query():
+    # This query gets the username of the person the certificate was assigned to
+    return db.session.query(
+        User.username,
+        Certificate.asset_id,
+        Certificate.equipment,
+        Certificate.site,
+        Certificate.inspection_date,
+        Certificate.expiry_date,
+        Certificate.status,
+        Certificate.renewal_status,
+        Certificate.pdf_path
+    ).join(User, Certificate.user_id == User.id) # This connects Cert owner to User table
+
+
+def sheet_row(r):
+    has_pdf = "Yes" if r.pdf_path else "No"
+    # We use r[0], r[1] etc. to ensure we get exactly what the query returned
+    return [r[0], r[1], r[2], r[3], r[4], format_date(r[5]), r[6], r[7] , has_pdf]
+
+
+def sync_to_google_sheets(sheet=None):
+    import gspread
+
     try:
         print("--- Starting Sync ---")
-        update_all_statuses()
-        # 1. Setup Google Credentials
-        creds = get_google_creds()
-        client = gspread.authorize(creds)
-        print("Authenticated with Google.")
-
-        # 2. Open your sheet
-        sheet = client.open("RR_Solutions_Master_Data").sheet1
+        # Anything already queued is covered by this full rewrite
+        last_job = db.session.query(db.func.max(SyncJob.id)).scalar()
+
+        # 1. Setup Google Credentials and open your sheet
+        sheet = sheet or get_master_sheet()
         print("Successfully opened Google Sheet.")
 
-        # 3. Pull ALL data from SQLite
-        with app.app_context():
-            # This query gets the username of the person the certificate was assigned to
-            results = db.session.query(
-                User.username,
-                Certificate.asset_id,
-                Certificate.equipment,
-                Certificate.site,
-                Certificate.inspection_date,
-                Certificate.expiry_date,
-                Certificate.status,
-                Certificate.renewal_status,
-                Certificate.pdf_path
-            ).join(User, Certificate.user_id == User.id).all() # This connects Cert owner to User table
-
-        print(f"Fetched {len(results)} records from SQLite.")
+        # 2. Pull ALL data from the database
+        results = sheet_rows_query().all()
+
+        print(f"Fetched {len(results)} records from the database.")
 
         if not results:
             print("No data in database to sync.")
             return
 
-        # 4. Format for Google Sheets
-        headers = ["Username", "Asset ID", "Equipment", "Site", "Inspection Date", "Expiry Date", "Status", "Renewal Stage" ,"Has PDF?"]
-        rows = [headers]
-
-        for r in results:
-            has_pdf = "Yes" if r.pdf_path else "No"
-            # We use r[0], r[1] etc. to ensure we get exactly what the query returned
-            rows.append([r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7] , has_pdf])
-            
-        # 5. Overwrite the sheet
-        sheet.clear()
+        # 3. Format for Google Sheets
+        rows = [SHEET_HEADERS] + [sheet_row(r) for r in results]
+
+        # 4. Overwrite the sheet
+        with api_metrics.timed('sheets.clear'):
+            sheet.clear()
         # Using the safer updated syntax
-        sheet.update(values=rows, range_name='A1')
+        with api_metrics.timed('sheets.update'):
+            sheet.update(values=rows, range_name='A1')
+
+        if last_job:
+            SyncJob.query.filter(SyncJob.id <= last_job).delete(synchronize_session=False)
+            db.session.commit()
 
         print("--- Sync Complete! Data is now in Google Sheets ---")
         return True
 
     except gspread.exceptions.SpreadsheetNotFound:
-        print("ERROR: Could not find a sheet named 'RR_Solutions_Master_Data'. Make sure the name matches exactly.")
+        print(f"ERROR: Could not find a sheet named '{SHEET_NAME}'. Make sure the name matches exactly.")
     except Exception as e:
         print(f"CRITICAL ERROR: {str(e)}")
         return False
 
 
+# --- ANALYTICS ROLLUPS ---
+# Certificate columns the rollups group by; expiry_date is bucketed by month
+ROLLUP_COLUMNS = ('user_id', 'status', 'renewal_status', 'site', 'equipment', 'form_type', 'expiry_date')
+ROLLUP_DIMENSIONS = ('status', 'renewal_status', 'site', 'equipment', 'form_type', 'expiry_month')
+
+
+def rollup_buckets(values):
+    # (dimension, bucket) pairs one certificate counts toward
+    expiry = values.get('expiry_date')
+    month = format_date(parse_date(expiry))[:7] if expiry else ''
+    return [(dim, month if dim == 'expiry_month' else (values.get(dim) or '')[:100]) for dim in ROLLUP_DIMENSIONS]
+
+
+def count_rollup(deltas, values, sign):
+    # Add (sign=1) or remove (sign=-1) one certificate, given as a dict of ROLLUP_COLUMNS
+    for dim, bucket in rollup_buckets(values):
+        deltas[(values['user_id'], dim, bucket)] += sign
+
+
+def move_rollup(deltas, user_id, dimension, old, new):
+    deltas[(user_id, dimension, old or '')] -= 1
+    deltas[(user_id, dimension, new or '')] += 1
+
+
+def upsert_insert(dialect, table):
+    # INSERT construct with .on_conflict_do_update()/.on_conflict_do_nothing() (PostgreSQL, SQLite)
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def apply_rollup_deltas(deltas, connection=None):
+    """Add the counted changes to certificate_rollup in the caller's transaction.
+
+    One atomic `total = total + n` upsert per bucket on PostgreSQL and SQLite, so concurrent
+    writers never lose counts.
+    """
+    rows = [{"user_id": u, "dimension": d, "bucket": b, "total": n} for (u, d, b), n in deltas.items() if n]
+    if not rows:
+        return
+    executor = connection if connection is not None else db.session
+    dialect = (connection if connection is not None else db.session.get_bind()).dialect.name
+    table = CertificateRollup.__table__
+
+    if dialect in ('postgresql', 'sqlite'):
+        stmt = upsert_insert(dialect, table)
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.user_id, table.c.dimension, table.c.bucket],
+                                          set_={"total": table.c.total + stmt.excluded.total})
+        executor.execute(stmt, rows)
+        return
+
+    for row in rows:
+        updated = executor.execute(table.update().where(
+            table.c.user_id == row['user_id'], table.c.dimension == row['dimension'],
+            table.c.bucket == row['bucket']).values(total=table.c.total + row['total']))
+        if not updated.rowcount:
+            executor.execute(table.insert().values(**row))
+
+
+def certificate_values(target, old=False):
+    # ROLLUP_COLUMNS of a Certificate instance, as they were before this flush when old=True
+    values = {}
+    state = inspect(target)
+    for column in ROLLUP_COLUMNS:
+        history = state.attrs[column].history
+        values[column] = history.deleted[0] if old and history.deleted else getattr(target, column)
+    return values
+
+
+# ORM writes (add_certificate, request_retest, delete_certificate) keep the rollups current
+# through these events; bulk statements call apply_rollup_deltas themselves
+@event.listens_for(Certificate, 'after_insert')
+def rollup_certificate_insert(mapper, connection, target):
+    deltas = Counter()
+    count_rollup(deltas, certificate_values(target), 1)
+    apply_rollup_deltas(deltas, connection)
+
+
+@event.listens_for(Certificate, 'after_update')
+def rollup_certificate_update(mapper, connection, target):
+    deltas = Counter()
+    count_rollup(deltas, certificate_values(target, old=True), -1)
+    count_rollup(deltas, certificate_values(target), 1)
+    apply_rollup_deltas(deltas, connection)
+
+
+@event.listens_for(Certificate, 'after_delete')
+def rollup_certificate_delete(mapper, connection, target):
+    deltas = Counter()
+    count_rollup(deltas, certificate_values(target, old=True), -1)
+    apply_rollup_deltas(deltas, connection)
+
+
+def rebuild_rollups():
+    """Recompute certificate_rollup from the certificate table with one GROUP BY per dimension."""
+    table = CertificateRollup.__table__
+    expressions = {
+        'expiry_month': db.func.substr(db.cast(Certificate.expiry_date, db.String), 1, 7),
+        **{dim: getattr(Certificate, dim) for dim in ROLLUP_DIMENSIONS if dim != 'expiry_month'},
+    }
+    db.session.execute(table.delete())
+    for dim, expression in expressions.items():
+        bucket = db.func.coalesce(expression, '')
+        grouped = db.select(Certificate.user_id, db.literal(dim), bucket, db.func.count()).group_by(
+            Certificate.user_id, bucket)
+        db.session.execute(table.insert().from_select(['user_id', 'dimension', 'bucket', 'total'], grouped))
+    db.session.commit()
+
+
+@portal.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the analytics rollups from scratch (after manual edits to the certificate table)."""
+    rebuild_rollups()
+    print(f"{CertificateRollup.query.count()} rollup rows written.")
+
+
+# --- INCREMENTAL SHEET SYNC (OUTBOX) ---
+sheet_sync_wakeup = threading.Event()
+
+
+def queue_sheet_sync(*asset_ids):
+    """Record that these assets' sheet rows are stale.
+
+    The jobs join the caller's transaction, so they are only durable once the caller commits.
+    """
+    if not asset_ids:
+        return
+    db.session.add_all([SyncJob(asset_id=a) for a in asset_ids])
+    sheet_sync_wakeup.set()
+
+
+def claim_sync_jobs():
+    # Claim every pending (or abandoned) job for this run so parallel workers don't double-push
+    token = str(uuid.uuid4())
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=SHEET_SYNC_CLAIM_TIMEOUT)
+    SyncJob.query.filter(
+        db.or_(SyncJob.claimed_by.is_(None), SyncJob.claimed_at < stale)
+    ).update({SyncJob.claimed_by: token, SyncJob.claimed_at: now}, synchronize_session=False)
+    db.session.commit()
+    return token
+
+
+def process_sync_outbox(sheet=None):
+    """Push the rows queued in the outbox to the sheet. Returns the number of assets pushed.
+
+    Rows are matched by asset_id (column B). Changed rows are rewritten in place and deleted
+    ones blanked with one batched update per run. New rows go through append_rows, which
+    Sheets places after the last row itself, so workers draining at the same time never
+    write to the same row numbers.
+    """
+    token = claim_sync_jobs()
+    jobs = SyncJob.query.filter_by(claimed_by=token)
+    asset_ids = sorted({j.asset_id for j in jobs})
+    if not asset_ids:
+        return 0
+
+    try:
+        sheet = sheet or get_master_sheet()
+        with api_metrics.timed('sheets.col_values'):
+            sheet_ids = sheet.col_values(2)
+        positions = {a: i + 1 for i, a in enumerate(sheet_ids) if i > 0}
+
+        current = {r.asset_id: r for r in sheet_rows_query().filter(Certificate.asset_id.in_(asset_ids))}
+
+        updates = []
+        if not sheet_ids:
+            updates.append({'range': 'A1:I1', 'values': [SHEET_HEADERS]})
+        appended, cleared = [], []
+        for asset_id in asset_ids:
+            row = positions.get(asset_id)
+            if asset_id in current and row:
+                updates.append({'range': f'A{row}:I{row}', 'values': [sheet_row(current[asset_id])]})
+            elif asset_id in current:
+                appended.append(sheet_row(current[asset_id]))
+            elif row:
+                cleared.append(f'A{row}:I{row}')
+
+        if updates:
+            with api_metrics.timed('sheets.batch_update'):
+                sheet.batch_update(updates)
+        if appended:
+            with api_metrics.timed('sheets.append_rows'):
+                sheet.append_rows(appended, table_range='A1')
+        if cleared:
+            with api_metrics.timed('sheets.batch_clear'):
+                sheet.batch_clear(cleared)
+    except Exception:
+        # Release the claim so the next run retries these jobs
+        db.session.rollback()
+        SyncJob.query.filter_by(claimed_by=token).update({SyncJob.claimed_by: None}, synchronize_session=False)
+        db.session.commit()
+        raise
+
+    SyncJob.query.filter_by(claimed_by=token).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"Sheet Sync: pushed {len(asset_ids)} changed rows.")
+    return len(asset_ids)
+
+
+def sheet_sync_loop(app):
+    while True:
+        # Wake on a new change (or periodically, to pick up jobs queued by other workers)
+        sheet_sync_wakeup.wait(timeout=60)
+        sheet_sync_wakeup.clear()
+        # Debounce: let the rest of a burst land before pushing
+        time.sleep(SHEET_SYNC_DEBOUNCE)
+        try:
+            with app.app_context():
+                process_sync_outbox()
+        except Exception as e:
+            print(f"Sheet Sync Error: {e}")
+
+
+def start_sheet_sync_worker(app):
+    thread = threading.Thread(target=sheet_sync_loop, args=(app,), name='sheet-sync', daemon=True)
+    thread.start()
+    return thread
+
+
+# --- CACHING ---
+class TTLCache:
+    """In-process LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Same interface as TTLCache, backed by Redis so every gunicorn worker shares it."""
+
+    def __init__(self, url, ttl=60, prefix='rr:cache:'):
+        import redis  # Optional dependency, only needed when CACHE_REDIS_URL is set
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + k for k in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+
+class DashboardCache:
+    """Per-user cache for the dashboard reads, with hit/miss counters.
+
+    Keys include today's date so day-relative numbers ("expires in 3 days") roll over
+    at midnight on their own. Write paths call invalidate() for the affected users.
+    """
+    KINDS = ('summary', 'renewals')
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, user_id, kind):
+        return f"{kind}:{user_id}:{date.today().isoformat()}"
+
+    def get_or_compute(self, user_id, kind, compute):
+        key = self._key(user_id, kind)
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            value = compute()
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self, *user_ids):
+        self.backend.delete(*[self._key(u, kind) for u in set(user_ids) for kind in self.KINDS])
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+            }
+
+
+def make_cache_backend(ttl=CACHE_TTL, prefix='rr:cache:'):
+    if CACHE_REDIS_URL:
+        return RedisCache(CACHE_REDIS_URL, ttl=ttl, prefix=prefix)
+    return TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=ttl)
+
+
+dashboard_cache = DashboardCache(make_cache_backend())
+# Public verify lookups by asset_id ("snap:<id>" for the record, "html:<id>" for the rendered page)
+verify_cache = make_cache_backend(ttl=VERIFY_CACHE_TTL, prefix='rr:verify:')
+
+
+def verify_key(kind, asset_id):
+    # Keyed by day: the page shows a status that flips at midnight, and without Redis the
+    # worker running the expiry transition can only clear its own cache
+    return f"{kind}:{asset_id}:{date.today().isoformat()}"
+
+
+def invalidate_verify(*asset_ids):
+    verify_cache.delete(*[verify_key(kind, a) for a in asset_ids for kind in ('snap', 'html')])
+
+
+# --- INSTRUMENTATION ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestMetrics:
+    # Per-route latency histograms and SQL totals, rendered in Prometheus text format
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.responses = {}
+
+    def observe(self, route, method, status, seconds, db_queries, db_seconds):
+        with self._lock:
+            stat = self.routes.get((route, method))
+            if stat is None:
+                stat = self.routes[(route, method)] = {
+                    "buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0,
+                    "db_queries": 0, "db_seconds": 0.0,
+                }
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stat["buckets"][i] += 1
+            stat["sum"] += seconds
+            stat["count"] += 1
+            stat["db_queries"] += db_queries
+            stat["db_seconds"] += db_seconds
+            key = (route, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def render(self):
+        with self._lock:
+            lines = [
+                "# HELP rr_http_request_duration_seconds Request latency by route.",
+                "# TYPE rr_http_request_duration_seconds histogram",
+            ]
+            for (route, method), stat in sorted(self.routes.items()):
+                labels = f'route="{route}",method="{method}"'
+                for bound, count in zip(LATENCY_BUCKETS, stat["buckets"]):
+                    lines.append(f'rr_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'rr_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stat["count"]}')
+                lines.append(f'rr_http_request_duration_seconds_sum{{{labels}}} {stat["sum"]:.6f}')
+                lines.append(f'rr_http_request_duration_seconds_count{{{labels}}} {stat["count"]}')
+
+            lines += ["# HELP rr_http_responses_total Responses by route and status.",
+                      "# TYPE rr_http_responses_total counter"]
+            for (route, method, status), count in sorted(self.responses.items()):
+                lines.append(f'rr_http_responses_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+
+            lines += ["# HELP rr_request_db_queries_total SQL statements run while serving each route.",
+                      "# TYPE rr_request_db_queries_total counter"]
+            for (route, method), stat in sorted(self.routes.items()):
+                lines.append(f'rr_request_db_queries_total{{route="{route}",method="{method}"}} {stat["db_queries"]}')
+            lines += ["# HELP rr_request_db_seconds_total Time spent in SQL while serving each route.",
+                      "# TYPE rr_request_db_seconds_total counter"]
+            for (route, method), stat in sorted(self.routes.items()):
+                lines.append(f'rr_request_db_seconds_total{{route="{route}",method="{method}"}} {stat["db_seconds"]:.6f}')
+            return lines
+
+
+request_metrics = RequestMetrics()
+
+
+def render_metrics():
+    lines = request_metrics.render()
+
+    pool_stats = db_stats.snapshot()
+    lines += ["# TYPE rr_db_events_total counter"]
+    for name in ("connects", "checkouts", "checkins", "invalidated", "queries", "slow_queries"):
+        lines.append(f'rr_db_events_total{{event="{name}"}} {pool_stats[name]}')
+
+    lines += ["# HELP rr_google_api_calls_total Outbound Google API calls (and client setup).",
+              "# TYPE rr_google_api_calls_total counter"]
+    google = api_metrics.snapshot()
+    for name, stat in sorted(google.items()):
+        lines.append(f'rr_google_api_calls_total{{call="{name}"}} {stat["calls"]}')
+    lines += ["# TYPE rr_google_api_seconds_total counter"]
+    for name, stat in sorted(google.items()):
+        lines.append(f'rr_google_api_seconds_total{{call="{name}"}} {stat["total_ms"] / 1000:.6f}')
+
+    cache = dashboard_cache.stats()
+    lines += ["# TYPE rr_dashboard_cache_total counter",
+              f'rr_dashboard_cache_total{{result="hit"}} {cache["hits"]}',
+              f'rr_dashboard_cache_total{{result="miss"}} {cache["misses"]}']
+    return "\n".join(lines) + "\n"
+
+
+@portal.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+    # Admins can profile a single request by sending "X-Profile: 1"
+    if request.headers.get('X-Profile') == '1' and current_user.is_authenticated and current_user.is_admin:
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@portal.after_app_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_metrics.observe(route, request.method, response.status_code, elapsed, g.db_queries, g.db_seconds)
+    if g.db_queries > QUERY_COUNT_WARN:
+        print(f"Query Budget: {request.method} {route} ran {g.db_queries} queries in {elapsed * 1000:.0f} ms")
+
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.disable()
+        response.headers['X-Profile-Report'] = save_profile(profiler, route)
+    response.headers['Server-Timing'] = f'app;dur={elapsed * 1000:.1f}, db;dur={g.db_seconds * 1000:.1f}'
+    return response
+
+
+def save_profile(profiler, route):
+    # Keeps the raw .prof (for snakeviz etc.) and a text summary; returns the report name
+    import pstats
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'index'}-{uuid.uuid4().hex[:6]}"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
+    with open(os.path.join(PROFILE_DIR, name + '.txt'), 'w') as f:
+        pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(40)
+    return name
+
+
+# --- AUTH ---
+class SessionUser(UserMixin):
+    """The logged-in user as cached between requests: a plain snapshot, not an ORM row."""
+
+    def __init__(self, id, username, email=None, role='client'):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.role = role
+
+    @property
+    def is_admin(self):
+        return self.role == 'admin'
+
+
+def user_snapshot(user):
+    return {"id": user.id, "username": user.username, "email": user.email, "role": user.role}
+
+
+# Shared across workers when CACHE_REDIS_URL is set; the TTL bounds staleness otherwise
+user_cache = make_cache_backend(ttl=SESSION_USER_TTL, prefix='rr:user:')
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_session_user(mapper, connection, target):
+    user_cache.delete(str(target.id))
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    snapshot = user_cache.get(str(user_id))
+    if snapshot is None:
+        user = db.session.get(User, int(user_id))
+        if user is None:
+            return None
+        snapshot = user_snapshot(user)
+        user_cache.set(str(user_id), snapshot)
+    return SessionUser(**snapshot)
+
+
+class LoginThrottle:
+    """Sliding-window limit on login attempts per key (client IP, username)."""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._attempts = {}
+
+    def hit(self, *keys):
+        # Records an attempt against every key; returns the seconds to wait if any key is
+        # already at the limit (nothing is recorded then), otherwise 0
+        now = time.monotonic()
+        with self._lock:
+            if len(self._attempts) > 10000:
+                self._attempts = {k: q for k, q in self._attempts.items() if q and q[-1] > now - self.window}
+            wait = 0
+            for key in keys:
+                attempts = self._attempts.setdefault(key, deque())
+                while attempts and attempts[0] <= now - self.window:
+                    attempts.popleft()
+                if len(attempts) >= self.limit:
+                    wait = max(wait, attempts[0] + self.window - now)
+            if not wait:
+                for key in keys:
+                    self._attempts[key].append(now)
+            return wait
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+
+login_throttle = LoginThrottle(LOGIN_RATE_LIMIT, LOGIN_RATE_WINDOW)
+
+# pbkdf2 releases the GIL, so a small pool caps how many cores a login storm can take
+# while the rest of the worker keeps serving requests
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+password_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_LIMIT)
+
+
+def run_password_hash(fn, *args):
+    """Run generate/check_password_hash on the hashing pool; None when the pool is full."""
+    if not password_slots.acquire(blocking=False):
+        return None
+    try:
+        return password_executor.submit(fn, *args).result()
+    finally:
+        password_slots.release()
+
+
+def auth_busy_response(message, retry_after, code):
+    response = jsonify({"status": "error", "message": message})
+    response.headers['Retry-After'] = str(max(1, round(retry_after)))
+    return response, code
+
 
 # --- AUTH ROUTES ---
 
 
-@app.route('/')
+@portal.route('/')
 def index():
     return render_template('index.html')
 
 
-@app.route('/api/register', methods=['POST'])
+@portal.route('/api/register', methods=['POST'])
 @login_required  # Now requires a login to even reach this
 def register():
     # 1. SECURITY: Only the admin can create new accounts
-    if current_user.username != 'admin':
+    if not current_user.is_admin:
         return jsonify({"status": "error", "message": "Unauthorized: Only admin can create users"}), 403
 
     data = request.json
@@ -242,7 +1778,9 @@ def register():
         return jsonify({"status": "error", "message": "User already exists"}), 400
 
     # 2. Create the user with hashed password
-    hashed = generate_password_hash(password, method='pbkdf2:sha256')
+    hashed = run_password_hash(generate_password_hash, password, 'pbkdf2:sha256')
+    if hashed is None:
+        return auth_busy_response("Server busy, please try again", 1, 503)
     new_user = User(username=username, password=hashed, email=email)
     db.session.add(new_user)
     db.session.commit()
@@ -250,41 +1788,116 @@ def register():
     return jsonify({"status": "success", "message": f"Account for {username} created!"})
 
 
-@app.route('/api/login', methods=['POST'])
+@portal.route('/api/login', methods=['POST'])
 def login():
-    data = request.json
-    user = User.query.filter_by(username=data['username']).first()
-    if user and check_password_hash(user.password, data['password']):
-        login_user(user, remember=True)
-        return jsonify({"status": "success"})
+    data = request.get_json(silent=True) or {}
+    username = str(data.get('username') or '')
+    user_key = f"user:{username.lower()}"
+    # remote_addr is the client's address, not the load balancer's (ProxyFix, see create_app)
+    wait = login_throttle.hit(f"ip:{request.remote_addr}", user_key)
+    if wait:
+        return auth_busy_response("Too many login attempts, please wait and try again", wait, 429)
+
+    user = User.query.filter_by(username=username).first()
+    if user:
+        valid = run_password_hash(check_password_hash, user.password, str(data.get('password') or ''))
+        if valid is None:
+            return auth_busy_response("Server busy, please try again", 1, 503)
+        if valid:
+            login_throttle.reset(user_key)
+            user_cache.set(str(user.id), user_snapshot(user))
+            login_user(user, remember=True)
+            return jsonify({"status": "success", "role": user.role})
     return jsonify({"status": "error", "message": "Invalid Login"}), 401
 
 
-# --- DASHBOARD & STATS (SQLite Only) ---
-@app.route('/api/dashboard_stats')
+# --- DASHBOARD & STATS ---
+def dashboard_summary(user_id, today=None):
+    """All dashboard numbers for one user from a single GROUP BY query.
+
+    Returns the stat cards (expired on or before today, "soon" within 7 days) and the
+    chart series (Valid vs other statuses, and counts per equipment type).
+    """
+    today = today or date.today()
+    bucket = db.case(
+        (Certificate.expiry_date.is_(None), None),
+        (Certificate.expiry_date <= today, 'expired'),
+        (Certificate.expiry_date <= today + timedelta(days=7), 'soon'),
+        else_='valid'
+    )
+    # Bucket in a subquery so PostgreSQL can group on a plain column
+    certs = db.session.query(
+        Certificate.equipment, Certificate.status, bucket.label('bucket')
+    ).filter(Certificate.user_id == user_id).subquery()
+    rows = db.session.query(
+        certs.c.equipment, certs.c.status, certs.c.bucket, db.func.count()
+    ).group_by(certs.c.equipment, certs.c.status, certs.c.bucket).all()
+
+    stats = {"total": 0, "valid": 0, "soon": 0, "expired": 0}
+    valid_status = 0
+    types = {}
+    for equipment, status, expiry_bucket, count in rows:
+        stats["total"] += count
+        if expiry_bucket:
+            stats[expiry_bucket] += count
+        if status == "Valid":
+            valid_status += count
+        equipment = equipment or "Unspecified"
+        types[equipment] = types.get(equipment, 0) + count
+
+    type_labels = sorted(types, key=lambda t: (-types[t], t))
+    chart = {
+        "status_labels": ["Valid", "Expired"],
+        "status_values": [valid_status, stats["total"] - valid_status],
+        "type_labels": type_labels, "type_values": [types[t] for t in type_labels]
+    }
+    return {"stats": stats, "chart": chart}
+
+
+def notifications_for_user(user_id, today=None, unread_only=False):
+    # Materialized alerts still upcoming, off the (user_id, expiry_date) index. The join drops
+    # alerts for certificates renewed, reassigned or deleted since the alert was written.
+    today = today or date.today()
+    query = db.session.query(Notification.id, Notification.asset_id, Notification.expiry_date,
+                             Notification.read_at).join(Certificate, notification_is_live()).filter(
+        Notification.user_id == user_id, Notification.expiry_date > today)
+
+    alerts = {}
+    for n in query.order_by(Notification.expiry_date, Notification.asset_id, Notification.id.desc()):
+        if n.asset_id in alerts:
+            continue  # the "tomorrow" alert supersedes the earlier "week" one
+        days = (n.expiry_date - today).days
+        alert = {"id": n.asset_id, "notification_id": n.id, "read": n.read_at is not None}
+        if days == 1:
+            alert.update(msg="Expires Tomorrow", type="urgent")
+        else:
+            alert.update(msg=f"Expires in {days} days", type="warning")
+        alerts[n.asset_id] = alert
+    return [a for a in alerts.values() if not (unread_only and a["read"])]
+
+
+@portal.route('/api/dashboard')
 @login_required
-def dashboard_stats():
-    update_all_statuses()
-    user_certs = Certificate.query.filter_by(user_id=current_user.id).all()
-    today = datetime.now()
-    stats = {"total": len(user_certs), "valid": 0, "soon": 0, "expired": 0}
+def dashboard():
+    # Everything the dashboard shows in one request
+    user_id = current_user.id
+    summary = dict(dashboard_cache.get_or_compute(user_id, 'summary', lambda: dashboard_summary(user_id)))
+    summary["notifications"] = notifications_for_user(user_id, unread_only=True)
+    return jsonify(summary)
 
-    for c in user_certs:
-        try:
-            exp = datetime.strptime(c.expiry_date, '%Y-%m-%d')
-            days = (exp - today).days
-            if days < 0: stats["expired"] += 1
-            elif 0 <= days <= 7: stats["soon"] += 1
-            else: stats["valid"] += 1
-        except: continue
-    return jsonify(stats)
+
+@portal.route('/api/dashboard_stats')
+@login_required
+def dashboard_stats():
+    user_id = current_user.id
+    return jsonify(dashboard_cache.get_or_compute(user_id, 'summary', lambda: dashboard_summary(user_id))["stats"])
 
 
 # --- CERTIFICATE CRUD ---
-@app.route('/api/add_certificate', methods=['POST'])
+@portal.route('/api/add_certificate', methods=['POST'])
 @login_required
 def add_cert():
-    if current_user.username != 'admin':
+    if not current_user.is_admin:
         return jsonify({"message": "Unauthorized"}), 403
 
     asset_id = request.form.get('id')
@@ -294,44 +1907,368 @@ def add_cert():
     if not target_user:
         return jsonify({"status": "error", "message": "Client not found"}), 404
 
-    file = request.files.get('pdf_file')
-    drive_link = ""
+    try:
+        expiry_date = parse_date(request.form.get('expiry_date'))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Expiry date must be YYYY-MM-DD"}), 400
 
+    try:
+        expected_version = int(request.form['version']) if request.form.get('version') else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Version must be a number"}), 400
+
+    # A retried submission (same Idempotency-Key) gets the first response back instead of writing again
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key:
+        replay = replay_idempotent(idempotency_key)
+        if replay:
+            return replay
+
+    file = request.files.get('pdf_file')
+    values = {
+        "inspection_date": request.form.get('date'),
+        "expiry_date": expiry_date,
+        "status": status_for_expiry(expiry_date),
+        "equipment": request.form.get('type'),
+        "site": request.form.get('site'),
+        "renewal_status": "Not Started",
+    }
+
+    # The PDF is kept in the local store right away and copied to Google Drive in the background
+    pdf = SimpleNamespace(pdf_status=None)
+    replicate = attach_pdf(pdf, file) if file else None
     if file:
-        # Instead of saving locally, we send the stream to Google Drive
-        filename = f"{asset_id}.pdf"
-        drive_link = upload_pdf_to_drive(file, filename)
-        print(f"DEBUG: Drive Link generated is: {drive_link}")
-
-        # Check if we are updating or creating
-    existing_cert = Certificate.query.filter_by(asset_id=asset_id).first()
-
-    if existing_cert:
-        existing_cert.inspection_date = request.form.get('date')
-        existing_cert.expiry_date = request.form.get('expiry_date')
-        existing_cert.equipment = request.form.get('type')
-        existing_cert.site = request.form.get('site')
-        existing_cert.renewal_status = "Not Started"
-        if drive_link:
-            existing_cert.pdf_path = drive_link # Save the DRIVE LINK instead of filename
-    else:
-        new_c = Certificate(
-            asset_id=asset_id,
-            equipment=request.form.get('type'),
-            site=request.form.get('site'),
-            inspection_date=request.form.get('date'),
-            expiry_date=request.form.get('expiry_date'),
-            pdf_path=drive_link, # Save the DRIVE LINK
-            user_id=target_user.id
-        )
-        db.session.add(new_c)
+        values.update(pdf_sha256=pdf.pdf_sha256, pdf_path=pdf.pdf_path, pdf_status=pdf.pdf_status)
 
+    try:
+        user_id, version, created = upsert_certificate(asset_id, values, target_user.id, expected_version)
+    except VersionConflict as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": "Certificate was changed by someone else",
+                        "version": e.current}), 409
+
+    queue_sheet_sync(asset_id)
+    body = {"status": "success", "pdf_status": pdf.pdf_status, "version": version, "created": created}
+    if idempotency_key:
+        remember_idempotent(idempotency_key, body)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The same Idempotency-Key committed first; this write is rolled back
+        db.session.rollback()
+        replay = replay_idempotent(idempotency_key) if idempotency_key else None
+        if replay:
+            return replay
+        raise
+    dashboard_cache.invalidate(user_id)
+    invalidate_verify(asset_id)
+    # Expiring this week? Alert now rather than at the next daily run
+    refresh_notifications(asset_ids=[asset_id])
+
+    if replicate:
+        queue_replication(replicate, f"{asset_id}.pdf")
+    return jsonify(body)
+
+
+class VersionConflict(Exception):
+    # The certificate isn't at the version the client expected (`current` is None if unknown)
+    def __init__(self, current=None):
+        super().__init__(current)
+        self.current = current
+
+
+def insert_if_absent(table, row, conflict_columns):
+    """INSERT ... ON CONFLICT DO NOTHING; returns the new id, or None if the row already exists."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        stmt = upsert_insert(dialect, table).values(**row).on_conflict_do_nothing(
+            index_elements=[table.c[c] for c in conflict_columns])
+        return db.session.execute(stmt.returning(table.c.id)).scalar()
+    try:
+        with db.session.begin_nested():
+            return db.session.execute(table.insert().values(**row)).inserted_primary_key[0]
+    except IntegrityError:
+        return None
+
+
+def upsert_certificate(asset_id, values, user_id, expected_version=None):
+    """Insert or update one certificate by asset_id, safe against concurrent writers.
+
+    New rows go in with INSERT ... ON CONFLICT DO NOTHING and existing ones are updated with a
+    compare-and-set on `version`, so a writer never applies its change on top of a row it
+    didn't read. A lost race is retried from a fresh read, unless the caller passed
+    expected_version, which raises VersionConflict instead. Nothing is committed.
+
+    Returns (user_id, new version, created).
+    """
+    table = Certificate.__table__
+    for _ in range(UPSERT_RETRIES):
+        old = db.session.execute(db.select(table.c.id, table.c.version, *[table.c[c] for c in ROLLUP_COLUMNS])
+                                 .where(table.c.asset_id == asset_id)).first()
+        deltas = Counter()
+        if old is None:
+            if expected_version is not None:
+                raise VersionConflict()
+            row = dict(values, asset_id=asset_id, user_id=user_id)
+            if insert_if_absent(table, row, ['asset_id']) is None:
+                continue  # another writer created it first; update that row instead
+            count_rollup(deltas, row, 1)
+            apply_rollup_deltas(deltas)
+            return user_id, 1, True
+
+        if expected_version is not None and old.version != expected_version:
+            raise VersionConflict(old.version)
+        updated = db.session.execute(table.update().where(table.c.id == old.id, table.c.version == old.version)
+                                     .values(**values, version=old.version + 1))
+        if updated.rowcount == 1:
+            # Bulk statements skip the ORM events, so move the rollups here
+            count_rollup(deltas, old._asdict(), -1)
+            count_rollup(deltas, dict(old._asdict(), **values), 1)
+            apply_rollup_deltas(deltas)
+            return old.user_id, old.version + 1, False
+        if expected_version is not None:
+            raise VersionConflict()
+    raise VersionConflict()
+
+
+def update_if_unchanged(rows):
+    """Batched compare-and-set UPDATE of certificates by id.
+
+    Each row dict has the id, the version it was read at and the columns to write; a row is
+    only updated if it is still at that version, and its new version is computed in SQL.
+    Returns how many rows were updated.
+    """
+    table = Certificate.__table__
+    # Rows from partial files write different columns, so each column set is one statement
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+
+    updated = 0
+    for keys, group in groups.items():
+        columns = [k for k in keys if k not in ('id', 'version')]
+        stmt = (table.update()
+                .where(table.c.id == db.bindparam('b_id'), table.c.version == db.bindparam('b_version'))
+                .values(version=table.c.version + 1, **{c: db.bindparam(f'b_{c}') for c in columns}))
+        params = [{f'b_{k}': v for k, v in row.items()} for row in group]
+        if db.session.get_bind().dialect.supports_sane_multi_rowcount:
+            updated += db.session.execute(stmt, params).rowcount
+        else:
+            # Drivers that can't count an executemany get one statement per row
+            updated += sum(db.session.execute(stmt, p).rowcount for p in params)
+    return updated
+
+
+def request_fingerprint():
+    # What a retried request has to match to be replayed under the same Idempotency-Key
+    parts = [request.path, json.dumps(sorted(request.form.items(multi=True)))]
+    parts += [f.filename or '' for f in request.files.values()]
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def replay_idempotent(key):
+    stored = db.session.get(IdempotencyKey, (current_user.id, key[:100]))
+    if not stored:
+        return None
+    if stored.request_hash != request_fingerprint():
+        return jsonify({"status": "error", "message": "Idempotency-Key was already used for a different request"}), 422
+    response = make_response(stored.response, stored.status_code)
+    response.mimetype = 'application/json'
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def remember_idempotent(key, body, status_code=200):
+    # Added to the session so it commits (or rolls back) together with the write
+    db.session.add(IdempotencyKey(user_id=current_user.id, key=key[:100], request_hash=request_fingerprint(),
+                                  status_code=status_code, response=json.dumps(body)))
+
+
+def prune_idempotency_keys():
+    cutoff = datetime.utcnow() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
     db.session.commit()
-    sync_to_google_sheets()
-    return jsonify({"status": "success"})
 
 
-@app.route('/api/request_retest/<asset_id>', methods=['POST'])
+# --- BULK IMPORT ---
+# Column names accepted in import files (certificates.json keys, export_csv headers, sheet headers)
+IMPORT_COLUMNS = {
+    'id': 'asset_id', 'asset_id': 'asset_id',
+    'type': 'equipment', 'equipment': 'equipment',
+    'site': 'site',
+    'form_type': 'form_type',
+    'date': 'inspection_date', 'inspection_date': 'inspection_date',
+    'expiry': 'expiry_date', 'expiry_date': 'expiry_date',
+    'username': 'username', 'name': 'username', 'client': 'username',
+}
+
+
+def read_import_file(file_obj):
+    # Returns the file's rows as dicts keyed by the raw column names
+    filename = (file_obj.filename or '').lower()
+    if filename.endswith('.json'):
+        return json.load(file_obj.stream)
+    if filename.endswith('.xlsx'):
+        import zipfile
+        from openpyxl import load_workbook
+        from openpyxl.utils.exceptions import InvalidFileException
+        try:
+            sheet = load_workbook(file_obj.stream, read_only=True, data_only=True).active
+        except (zipfile.BadZipFile, InvalidFileException, KeyError):
+            raise ValueError("Not a valid .xlsx workbook")
+        rows = sheet.iter_rows(values_only=True)
+        headers = [str(h or '') for h in next(rows, [])]
+        return [dict(zip(headers, r)) for r in rows if any(v is not None for v in r)]
+    if filename.endswith('.csv'):
+        return list(csv.DictReader(io.TextIOWrapper(file_obj.stream, encoding='utf-8-sig')))
+    raise ValueError("Unsupported file type, upload a .csv, .xlsx or .json file")
+
+
+def normalize_import_row(raw):
+    # Raises ValueError for anything that isn't a flat row (JSON files can hold any value)
+    if not isinstance(raw, dict):
+        raise ValueError("Row must be an object of column names and values")
+    row = {}
+    for key, value in raw.items():
+        field = IMPORT_COLUMNS.get(str(key).strip().lower().replace(' ', '_'))
+        if field and isinstance(value, (list, dict)):
+            raise ValueError(f"Column '{key}' must be a single value")
+        if field and value not in (None, ''):
+            row[field] = value.strip() if isinstance(value, str) else value
+    return row
+
+
+def import_certificates(records, default_client=None):
+    """Validate and upsert certificate records by asset_id in batched statements.
+
+    Returns a summary with inserted/updated counts and per-row errors (rows are 1-based).
+    """
+    errors = []
+    valid = {}
+    for n, raw in enumerate(records, start=1):
+        row = {}
+        try:
+            row = normalize_import_row(raw)
+            row.setdefault('username', default_client)
+            if not row.get('asset_id'):
+                raise ValueError("Missing asset id")
+            if not row.get('username'):
+                raise ValueError("Missing client username")
+            row['asset_id'] = str(row['asset_id'])
+            row['username'] = str(row['username'])
+            if 'expiry_date' in row:
+                try:
+                    row['expiry_date'] = parse_date(row['expiry_date'])
+                except ValueError:
+                    raise ValueError("Expiry date must be YYYY-MM-DD")
+            if isinstance(row.get('inspection_date'), date):
+                # Spreadsheet cells come back as dates, but inspection_date is stored as text
+                row['inspection_date'] = format_date(parse_date(row['inspection_date']))
+        except ValueError as e:
+            errors.append({"row": n, "asset_id": row.get('asset_id'), "error": str(e)})
+            continue
+        # A later row for the same asset wins, like repeated add_certificate calls
+        valid[row['asset_id']] = (n, row)
+
+    # Resolve every client username in one query
+    usernames = {row['username'] for _, row in valid.values()}
+    user_ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(usernames))) if usernames else {}
+
+    inserted = updated = 0
+    items = list(valid.values())
+    for start in range(0, len(items), IMPORT_BATCH_SIZE):
+        batch = items[start:start + IMPORT_BATCH_SIZE]
+        # Rows are written only if nobody changed them since they were read here; when a
+        # concurrent writer gets in between, the whole batch is redone from a fresh read
+        for _ in range(UPSERT_RETRIES):
+            existing = {
+                r.asset_id: r for r in
+                db.session.query(Certificate.asset_id, Certificate.id, Certificate.version,
+                                 *[getattr(Certificate, c) for c in ROLLUP_COLUMNS])
+                .filter(Certificate.asset_id.in_([row['asset_id'] for _, row in batch]))
+            }
+
+            # Bulk statements skip the ORM events that keep the rollups current, so count here
+            deltas = Counter()
+            new_rows, changed_rows, synced, batch_errors = [], [], [], []
+            for n, row in batch:
+                user_id = user_ids.get(row['username'])
+                if not user_id:
+                    batch_errors.append({"row": n, "asset_id": row['asset_id'],
+                                         "error": f"Client '{row['username']}' not found"})
+                    continue
+                # Only columns present in the file are written, so partial exports don't blank fields
+                values = {k: v for k, v in row.items() if k != 'username'}
+                values['user_id'] = user_id
+                if 'expiry_date' in row or row['asset_id'] not in existing:
+                    # A new expiry date is a new certificate, like add_certificate
+                    values.update(status=status_for_expiry(row.get('expiry_date')), renewal_status="Not Started")
+                if row['asset_id'] in existing:
+                    old = existing[row['asset_id']]._asdict()
+                    changed_rows.append(dict(values, id=old['id'], version=old['version']))
+                    count_rollup(deltas, old, -1)
+                    count_rollup(deltas, dict(old, **values), 1)
+                else:
+                    new_rows.append(values)
+                    count_rollup(deltas, values, 1)
+                synced.append(row['asset_id'])
+
+            try:
+                if new_rows:
+                    db.session.execute(db.insert(Certificate), new_rows)
+                if changed_rows and update_if_unchanged(changed_rows) != len(changed_rows):
+                    db.session.rollback()
+                    continue
+            except IntegrityError:
+                # Another writer created one of the new assets first
+                db.session.rollback()
+                continue
+            apply_rollup_deltas(deltas)
+            queue_sheet_sync(*synced)
+            db.session.commit()
+            invalidate_verify(*synced)
+            inserted += len(new_rows)
+            updated += len(changed_rows)
+            errors.extend(batch_errors)
+            break
+        else:
+            failed = {e['row'] for e in batch_errors}
+            errors.extend(batch_errors)
+            errors.extend({"row": n, "asset_id": row['asset_id'],
+                           "error": "Changed by someone else during the import, try again"}
+                          for n, row in batch if n not in failed)
+
+    dashboard_cache.invalidate(*user_ids.values())
+    if inserted or updated:
+        refresh_notifications()
+
+    errors.sort(key=lambda e: e['row'])
+    return {"inserted": inserted, "updated": updated, "errors": errors}
+
+
+@portal.route('/api/admin/import_certificates', methods=['POST'])
+@login_required
+def admin_import_certificates():
+    if not current_user.is_admin:
+        return jsonify({"message": "Unauthorized"}), 403
+
+    file = request.files.get('file')
+    if not file:
+        return jsonify({"status": "error", "message": "No file uploaded"}), 400
+
+    try:
+        records = read_import_file(file)
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({"status": "error", "message": f"Could not read file: {e}"}), 400
+    if not isinstance(records, list):
+        return jsonify({"status": "error", "message": "JSON imports must be a list of certificates"}), 400
+
+    # Files without a username column (like certificates.json) go to the client picked in the form
+    summary = import_certificates(records, default_client=request.form.get('client'))
+    return jsonify(dict(summary, status="success"))
+
+
+@portal.route('/api/request_retest/<asset_id>', methods=['POST'])
 @login_required
 def request_retest(asset_id):
     # Find the specific asset belonging to this user
@@ -340,49 +2277,145 @@ def request_retest(asset_id):
     if cert:
         # Update the renewal status in the DB
         cert.renewal_status = "Renewal Requested"
+        # Queue a Google Sheets sync so the Admin sees the request in Looker Studio
+        queue_sheet_sync(asset_id)
         db.session.commit()
-
-        # Sync to Google Sheets so the Admin sees the request in Looker Studio
-        sync_to_google_sheets()
+        dashboard_cache.invalidate(cert.user_id)
+        invalidate_verify(asset_id)
 
         return jsonify({"status": "success", "message": f"Renewal request for {asset_id} logged!"})
 
     return jsonify({"status": "error", "message": "Asset not found"}), 404
 
-@app.route('/api/certificates')
+def certificate_json(c):
+    # We convert the database objects into dictionaries for JavaScript
+    return {
+        "id": c.asset_id,
+        "type": c.equipment,
+        "site": c.site,
+        "expiry": format_date(c.expiry_date),
+        "status": c.status,
+        "renewal_status": c.renewal_status,
+        "pdf": pdf_url(c.pdf_path), # We include the PDF link so the user can open it
+        "pdf_status": c.pdf_status,
+        "version": c.version
+    }
+
+
+@portal.route('/api/certificates')
 @login_required
 def get_certs():
     # We query the database for certificates ONLY where user_id matches the logged-in user
-    update_all_statuses()
     user_certs = Certificate.query.filter_by(user_id=current_user.id).all()
+    return jsonify([certificate_json(c) for c in user_certs])
+
+
+# Sort keys for the paginated inventory (all covered by a (user_id, column, id) index)
+CERT_SORT_KEYS = {
+    "expiry": Certificate.expiry_date,
+    "id": Certificate.asset_id,
+    "site": Certificate.site,
+    "type": Certificate.equipment,
+}
+CERT_PAGE_DEFAULT = 50
+CERT_PAGE_MAX = 200
+
+
+def filter_certificates(query, args):
+    # Shared inventory filters: site, type, status, renewal_status, expiry_from, expiry_to.
+    # Raises ValueError for a malformed date.
+    for param, column in (('site', Certificate.site), ('type', Certificate.equipment),
+                          ('status', Certificate.status), ('renewal_status', Certificate.renewal_status)):
+        if args.get(param):
+            query = query.filter(column == args[param])
+    expiry_from = parse_date(args.get('expiry_from'))
+    expiry_to = parse_date(args.get('expiry_to'))
+    if expiry_from:
+        query = query.filter(Certificate.expiry_date >= expiry_from)
+    if expiry_to:
+        query = query.filter(Certificate.expiry_date <= expiry_to)
+    return query
+
+
+def encode_cursor(value, row_id):
+    raw = json.dumps([format_date(value) if isinstance(value, date) else value, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
-    # We convert the SQLite objects into a list of dictionaries for JavaScript
-    output = []
-    for c in user_certs:
-        output.append({
-            "id": c.asset_id,
-            "type": c.equipment,
-            "site": c.site,
-            "expiry": c.expiry_date,
-            "status": c.status,
-            "renewal_status": c.renewal_status,
-            "pdf": c.pdf_path # We include the PDF filename so the user can open it
-        })
-    return jsonify(output)
 
+def decode_cursor(cursor, sort_key):
+    value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if sort_key == "expiry" and value is not None:
+        value = parse_date(value)
+    return value, int(row_id)
 
-@app.route('/api/delete_certificate/<asset_id>', methods=['DELETE'])
+
+@portal.route('/api/certificates/page')
+@login_required
+def get_certs_page():
+    """Keyset-paginated inventory.
+
+    Query params: limit, cursor (from the previous page's next_cursor), sort (expiry, id, site,
+    type), order (asc/desc), and filters site, type, status, renewal_status, expiry_from, expiry_to.
+    """
+    args = request.args
+    sort_key = args.get('sort', 'expiry')
+    descending = args.get('order', 'asc') == 'desc'
+    if sort_key not in CERT_SORT_KEYS:
+        return jsonify({"status": "error", "message": f"Unknown sort key '{sort_key}'"}), 400
+    try:
+        limit = min(max(int(args.get('limit', CERT_PAGE_DEFAULT)), 1), CERT_PAGE_MAX)
+        cursor = decode_cursor(args['cursor'], sort_key) if args.get('cursor') else None
+        query = filter_certificates(Certificate.query.filter_by(user_id=current_user.id), args)
+    except (ValueError, TypeError):
+        return jsonify({"status": "error", "message": "Invalid limit, date or cursor"}), 400
+
+    # Rows are ordered by (sort column, id) with empty values last in both directions,
+    # and the cursor is the last row's pair, so each page continues where the last one ended
+    column = CERT_SORT_KEYS[sort_key]
+    if cursor:
+        value, last_id = cursor
+        after_id = Certificate.id < last_id if descending else Certificate.id > last_id
+        if value is None:
+            query = query.filter(column.is_(None), after_id)
+        else:
+            after_value = column < value if descending else column > value
+            query = query.filter(db.or_(after_value, db.and_(column == value, after_id), column.is_(None)))
+
+    if descending:
+        query = query.order_by(column.desc().nulls_last(), Certificate.id.desc())
+    else:
+        query = query.order_by(column.asc().nulls_last(), Certificate.id.asc())
+
+    certs = query.limit(limit + 1).all()
+    has_more = len(certs) > limit
+    certs = certs[:limit]
+    next_cursor = None
+    if has_more:
+        last = certs[-1]
+        next_cursor = encode_cursor(getattr(last, column.key), last.id)
+
+    response = jsonify({"items": [certificate_json(c) for c in certs], "next_cursor": next_cursor})
+    # Browsers revalidate with If-None-Match and get a 304 when the page hasn't changed
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@portal.route('/api/delete_certificate/<asset_id>', methods=['DELETE'])
 @login_required
 def delete_certificate(asset_id):
     cert = Certificate.query.filter_by(asset_id=asset_id, user_id=current_user.id).first()
     if cert:
         db.session.delete(cert)
+        queue_sheet_sync(asset_id)
         db.session.commit()
+        dashboard_cache.invalidate(current_user.id)
+        invalidate_verify(asset_id)
         return jsonify({"status": "success"})
     return jsonify({"status": "error", "message": "Not found"}), 404
 
 # Search By ID
-@app.route('/api/search_asset/<search_query>')
+@portal.route('/api/search_asset/<search_query>')
 @login_required
 def search_asset(search_query):
     # This filters by the Asset ID AND ensures it belongs to the logged-in user
@@ -398,117 +2431,632 @@ def search_asset(search_query):
                 "id": asset.asset_id,
                 "type": asset.equipment,
                 "site": asset.site,
-                "expiry": asset.expiry_date,
+                "expiry": format_date(asset.expiry_date),
                 "status": asset.status,
-                "pdf": asset.pdf_path
+                "pdf": pdf_url(asset.pdf_path)
             }
         })
     
     return jsonify({"status": "error", "message": "Asset not found in your inventory"}), 404
 
 
+# --- SEARCH ---
+SEARCH_COLUMNS = ('asset_id', 'equipment', 'site')
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+# A term matching more rows than this (across all tenants) is searched by walking the
+# tenant's asset_id index instead of through the trigram candidates
+SEARCH_FTS_CANDIDATES = 2000
+# Database URL -> "fts5", "trigram" or "scan"; filled in on first search
+search_backends = {}
+
+
+def search_backend():
+    key = str(db.engine.url)
+    if key not in search_backends:
+        backend = 'scan'
+        if db.engine.dialect.name == 'sqlite':
+            found = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'certificate_fts_ai'")).first()
+            backend = 'fts5' if found else 'scan'
+        elif db.engine.dialect.name == 'postgresql':
+            found = db.session.execute(text(
+                "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_certificate_asset_id_trgm'")).first()
+            backend = 'trigram' if found else 'scan'
+        search_backends[key] = backend
+    return search_backends[key]
+
+
+def parse_search(q):
+    # "KA262-FB* hose" -> [('ka262-fb', True), ('hose', False)]; a trailing * means prefix match
+    terms = []
+    for word in q.lower().split()[:5]:
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append((word, prefix))
+    return terms
+
+
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def term_condition(word, prefix):
+    # Substring of any search column; a prefix term has to start the value or a word in it
+    word = like_escape(word)
+    patterns = [word + '%', '% ' + word + '%'] if prefix else ['%' + word + '%']
+    return db.or_(*[db.func.lower(getattr(Certificate, c)).like(p, escape='\\')
+                    for c in SEARCH_COLUMNS for p in patterns])
+
+
+def fts_candidates(terms):
+    """Row ids whose text contains every 3+ character term, from the SQLite trigram index.
+
+    Returns None when the index can't narrow the search: no usable terms, or more than
+    SEARCH_FTS_CANDIDATES matches.
+    """
+    words = [word for word, _ in terms if len(word) >= 3]
+    if not words or search_backend() != 'fts5':
+        return None
+    match = ' AND '.join('"' + word.replace('"', '""') + '"' for word in words)
+    ids = db.session.execute(text("SELECT rowid FROM certificate_fts WHERE certificate_fts MATCH :match LIMIT :cap"),
+                             {"match": match, "cap": SEARCH_FTS_CANDIDATES + 1}).scalars().all()
+    return ids if len(ids) <= SEARCH_FTS_CANDIDATES else None
+
+
+def search_certificates(query, q, limit, offset=0):
+    """Rank and page the certificates in `query` that match every term of `q`.
+
+    Results come in three groups, each ordered by asset_id (case-insensitively): asset_id
+    starts with the first term (an exact match sorts first), equipment or site starts
+    with it, then any other match.
+    """
+    terms = parse_search(q)
+    if not terms:
+        return []
+    query = query.filter(*[term_condition(word, prefix) for word, prefix in terms])
+
+    first = terms[0][0]
+    asset = db.func.lower(Certificate.asset_id)
+    # Range rather than LIKE so the (user_id, lower(asset_id)) index can serve it
+    asset_prefix = db.and_(asset >= first, asset < first[:-1] + chr(ord(first[-1]) + 1))
+    pattern = like_escape(first) + '%'
+    # Coalesced so a missing equipment/site is "no match" rather than NULL, which NOT keeps NULL
+    other_prefix = db.or_(db.func.coalesce(db.func.lower(Certificate.equipment), '').like(pattern, escape='\\'),
+                          db.func.coalesce(db.func.lower(Certificate.site), '').like(pattern, escape='\\'))
+    order = (asset, Certificate.id)
+
+    candidates = fts_candidates(terms)
+    if candidates is not None or search_backend() == 'trigram':
+        # Few matches (or PostgreSQL, whose planner picks the trigram index itself): rank in one query
+        if candidates is not None:
+            query = query.filter(Certificate.id.in_(candidates))
+        rank = db.case((asset_prefix, 0), (other_prefix, 1), else_=2)
+        return query.order_by(rank, *order).offset(offset).limit(limit).all()
+
+    # Common or short terms: walk the tenant's asset_id index group by group, stopping as
+    # soon as the page is filled
+    results = []
+    wanted = offset + limit
+    for group in (asset_prefix, db.and_(db.not_(asset_prefix), other_prefix),
+                  db.and_(db.not_(asset_prefix), db.not_(other_prefix))):
+        results += query.filter(group).order_by(*order).limit(wanted - len(results)).all()
+        if len(results) >= wanted:
+            break
+    return results[offset:]
+
+
+@portal.route('/api/search')
+@login_required
+def search():
+    """Type-ahead search over the user's assets: ?q=, limit, offset.
+
+    The admin can search every client's assets with ?all=1.
+    """
+    q = request.args.get('q', '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_DEFAULT)), 1), SEARCH_PAGE_MAX)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid limit or offset"}), 400
+    if not q:
+        return jsonify({"items": [], "next_offset": None})
+
+    query = Certificate.query
+    if not (request.args.get('all') == '1' and current_user.is_admin):
+        query = query.filter(Certificate.user_id == current_user.id)
+    certs = search_certificates(query, q, limit + 1, offset)
+    has_more = len(certs) > limit
+    return jsonify({
+        "items": [certificate_json(c) for c in certs[:limit]],
+        "next_offset": offset + limit if has_more else None,
+    })
+
+
 # --- RENEWALS & NOTIFICATIONS ---
-@app.route('/api/notifications')
+@portal.route('/api/notifications')
 @login_required
 def get_notifications():
-    certs = Certificate.query.filter_by(user_id=current_user.id).all()
-    today = datetime.now()
-    alerts = []
-    for c in certs:
-        try:
-            exp = datetime.strptime(c.expiry_date, '%Y-%m-%d')
-            days = (exp - today).days
-            if days == 1: alerts.append({"id": c.asset_id, "msg": "Expires Tomorrow", "type": "urgent"})
-            elif 0 < days <= 7: alerts.append({"id": c.asset_id, "msg": f"Expires in {days} days", "type": "warning"})
-        except: continue
-    return jsonify(alerts)
+    # ?unread=1 returns only the alerts not yet marked read
+    return jsonify(notifications_for_user(current_user.id, unread_only=request.args.get('unread') == '1'))
 
 
-@app.route('/api/renewals', methods=['GET'])
+@portal.route('/api/notifications/read', methods=['POST'])
+@login_required
+def mark_notifications_read():
+    # Body: {"ids": [notification_id, ...]}, or {} to mark everything read
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids') if isinstance(data, dict) else data
+    if ids is not None and not (isinstance(ids, list) and all(isinstance(i, int) for i in ids)):
+        return jsonify({"status": "error", "message": "ids must be a list of notification ids"}), 400
+    query = Notification.query.filter(Notification.user_id == current_user.id, Notification.read_at.is_(None))
+    if ids is not None:
+        query = query.filter(Notification.id.in_(ids))
+    count = query.update({Notification.read_at: datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    return jsonify({"status": "success", "updated": count})
+
+
+def renewals_for_user(user_id, today=None):
+    # Everything already expired OR expiring within 60 days, most urgent first.
+    # One range scan on the (user_id, expiry_date) index through the shared engine.
+    today = today or date.today()
+    certs = db.session.query(
+        Certificate.asset_id, Certificate.equipment, Certificate.site, Certificate.expiry_date
+    ).filter(
+        Certificate.user_id == user_id,
+        Certificate.expiry_date <= today + timedelta(days=60)
+    ).order_by(Certificate.expiry_date, Certificate.id).all()
+
+    return [{
+        "id": c.asset_id,
+        "type": c.equipment,
+        "site": c.site,
+        "expiry_date": format_date(c.expiry_date),
+        "days_left": (c.expiry_date - today).days
+    } for c in certs]
+
+
+@portal.route('/api/renewals', methods=['GET'])
 @login_required
 def get_renewals():
-    # 1. Connect to the database
-    conn = sqlite3.connect('instance/rr_solutions.db')  # Ensure path matches your setup
-
-    # 2. Pull all certificates for the logged-in user into a Pandas DataFrame
-    query = f"SELECT asset_id as id, equipment as type, site, expiry_date FROM certificate WHERE user_id = {current_user.id}"
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-
-    if df.empty:
-        return jsonify([])
+    user_id = current_user.id
+    return jsonify(dashboard_cache.get_or_compute(user_id, 'renewals', lambda: renewals_for_user(user_id)))
 
-    # 3. Use Pandas magic to handle dates
-    today = pd.to_datetime(datetime.now().date())
-    df['expiry_date'] = pd.to_datetime(df['expiry_date'])
 
-    # Calculate days left
-    df['days_left'] = (df['expiry_date'] - today).dt.days
-
-    # 4. Filter: Show everything already expired OR expiring within 60 days
-    # (Matches your requirement to see the 2026-02-19 items)
-    renewals_df = df[df['days_left'] <= 60].copy()
+# --- CHARTS & PROFILE ---
+@portal.route('/api/chart_data')
+@login_required
+def chart_data():
+    user_id = current_user.id
+    return jsonify(dashboard_cache.get_or_compute(user_id, 'summary', lambda: dashboard_summary(user_id))["chart"])
+
+
+# Columns available to export_csv (?columns=asset_id,site,...), in output order
+EXPORT_COLUMNS = {
+    'username': ('Username', User.username),
+    'asset_id': ('Asset ID', Certificate.asset_id),
+    'form_type': ('Form Type', Certificate.form_type),
+    'equipment': ('Equipment', Certificate.equipment),
+    'site': ('Site', Certificate.site),
+    'inspection_date': ('Inspection Date', Certificate.inspection_date),
+    'expiry_date': ('Expiry', Certificate.expiry_date),
+    'status': ('Status', Certificate.status),
+    'renewal_status': ('Renewal Stage', Certificate.renewal_status),
+    'pdf': ('PDF', Certificate.pdf_path),
+}
+EXPORT_DEFAULT_COLUMNS = ['asset_id', 'equipment', 'site', 'expiry_date']
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_rows(query, columns):
+    # Rows come off a server-side cursor EXPORT_BATCH_SIZE at a time, so memory stays flat
+    try:
+        for row in query.execution_options(yield_per=EXPORT_BATCH_SIZE):
+            yield [format_date(v) if isinstance(v, date) else v for v in row]
+    finally:
+        # A streamed body outlives the request's session scope, so the query's session has
+        # to hand its connection back to the pool itself
+        query.session.close()
+
+
+def stream_csv(header, rows, compress=False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    gzip = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip container
+
+    def flush():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return gzip.compress(data) if gzip else data
+
+    writer.writerow(header)
+    for n, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if n % EXPORT_BATCH_SIZE == 0:
+            yield flush()
+    yield flush()
+    if gzip:
+        yield gzip.flush()
+
+
+@portal.route('/api/export_csv')
+@login_required
+def export_csv():
+    """Stream the inventory as CSV (default), gzip-compressed CSV (?format=csv.gz) or XLSX.
+
+    ?columns= picks columns from EXPORT_COLUMNS, the inventory filters apply, and the
+    admin can export every client's certificates with ?all=1.
+    """
+    args = request.args
+    columns = args.get('columns', '').split(',') if args.get('columns') else EXPORT_DEFAULT_COLUMNS
+    unknown = [c for c in columns if c not in EXPORT_COLUMNS]
+    if unknown:
+        return jsonify({"status": "error", "message": f"Unknown columns: {', '.join(unknown)}"}), 400
+    fmt = args.get('format', 'csv')
+    if fmt not in ('csv', 'csv.gz', 'xlsx'):
+        return jsonify({"status": "error", "message": "Format must be csv, csv.gz or xlsx"}), 400
+
+    query = db.session.query(*[EXPORT_COLUMNS[c][1] for c in columns]).select_from(Certificate)
+    if 'username' in columns:
+        query = query.join(User, Certificate.user_id == User.id)
+    if not (args.get('all') == '1' and current_user.is_admin):
+        query = query.filter(Certificate.user_id == current_user.id)
+    try:
+        query = filter_certificates(query, args).order_by(Certificate.id)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Dates must be YYYY-MM-DD"}), 400
+    header = [EXPORT_COLUMNS[c][0] for c in columns]
+
+    if fmt == 'xlsx':
+        from openpyxl import Workbook
+        # write_only mode streams rows to a temp file instead of keeping cells in memory
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('Report')
+        sheet.append(header)
+        for row in export_rows(query, columns):
+            sheet.append(row)
+        output = tempfile.TemporaryFile()
+        workbook.save(output)
+        output.seek(0)
+        return send_file(output, as_attachment=True, download_name='report.xlsx',
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    compress = fmt == 'csv.gz'
+    response = Response(stream_with_context(stream_csv(header, export_rows(query, columns), compress)),
+                        mimetype='application/gzip' if compress else 'text/csv')
+    response.headers["Content-Disposition"] = f"attachment; filename=report.{fmt}"
+    return response
 
-    # 5. Sort by most urgent
-    renewals_df = renewals_df.sort_values(by='days_left')
 
-    # 6. Convert expiry_date back to string for JSON (since JSON doesn't like Timestamps)
-    renewals_df['expiry_date'] = renewals_df['expiry_date'].dt.strftime('%Y-%m-%d')
+# --- ADMIN ANALYTICS ---
+# Renewal stages in funnel order; stages not listed here follow, largest first
+RENEWAL_STAGES = ["Not Started", "Renewal Requested"]
+ANALYTICS_TOP_BUCKETS = 50  # sites / equipment types listed per report
+
+
+def ranked(counter, limit=None):
+    return [{"name": name or None, "total": total} for name, total in counter.most_common(limit)]
+
+
+def analytics_report(user_id=None):
+    """Cross-client rollups read straight from certificate_rollup (a few rows per client)."""
+    query = db.session.query(CertificateRollup.user_id, CertificateRollup.dimension,
+                             CertificateRollup.bucket, CertificateRollup.total).filter(CertificateRollup.total > 0)
+    if user_id is not None:
+        query = query.filter(CertificateRollup.user_id == user_id)
+
+    dimensions = {dim: Counter() for dim in ROLLUP_DIMENSIONS}
+    clients = {}
+    for r in query:
+        dimensions[r.dimension][r.bucket] += r.total
+        if r.dimension in ('status', 'renewal_status'):
+            clients.setdefault(r.user_id, {"status": Counter(), "renewal_status": Counter()})[r.dimension][r.bucket] += r.total
+
+    names = dict(db.session.query(User.id, User.username).filter(User.id.in_(clients))) if clients else {}
+    per_client = [{
+        "client": names.get(uid),
+        "total": sum(c["status"].values()),
+        "valid": c["status"]["Valid"],
+        "expired": c["status"]["Expired"],
+        "renewal_requested": c["renewal_status"]["Renewal Requested"],
+    } for uid, c in clients.items()]
+    per_client.sort(key=lambda c: -c["total"])
+
+    stages = dimensions['renewal_status']
+    funnel = [{"stage": s, "total": stages[s]} for s in RENEWAL_STAGES]
+    funnel += [{"stage": s or None, "total": n} for s, n in stages.most_common() if s not in RENEWAL_STAGES]
+
+    return {
+        "total": sum(dimensions['status'].values()),
+        "clients": per_client,
+        "statuses": dict(dimensions['status']),
+        "sites": ranked(dimensions['site'], ANALYTICS_TOP_BUCKETS),
+        "equipment": ranked(dimensions['equipment'], ANALYTICS_TOP_BUCKETS),
+        "form_types": ranked(dimensions['form_type']),
+        "expiry_months": [{"month": m or None, "total": n} for m, n in sorted(dimensions['expiry_month'].items())],
+        "renewal_funnel": funnel,
+    }
+
+
+@portal.route('/api/admin/analytics')
+@login_required
+def admin_analytics():
+    """Per-client, per-site, per-equipment, expiry-month and renewal-stage counts (?client= for one client)."""
+    if not current_user.is_admin:
+        return jsonify({"message": "Unauthorized"}), 403
+    user_id = None
+    if request.args.get('client'):
+        user = User.query.filter_by(username=request.args['client']).first()
+        if not user:
+            return jsonify({"status": "error", "message": "Client not found"}), 404
+        user_id = user.id
+    return jsonify(analytics_report(user_id))
 
-    # 7. Convert DataFrame to a list of dictionaries for the frontend
-    result = renewals_df.to_dict(orient='records')
 
-    return jsonify(result)
+@portal.route('/api/admin/analytics/export')
+@login_required
+def export_analytics():
+    """Columnar export for reporting tools: ?format=parquet (default) or arrow (Arrow IPC file).
+
+    ?dataset=rollups (default) exports the rollup table; dataset=certificates exports every
+    certificate (EXPORT_COLUMNS), read in EXPORT_BATCH_SIZE batches. Needs pyarrow, which
+    is in requirements.txt but only imported here, so workers don't pay for it at startup.
+    """
+    if not current_user.is_admin:
+        return jsonify({"message": "Unauthorized"}), 403
+    fmt = request.args.get('format', 'parquet')
+    dataset = request.args.get('dataset', 'rollups')
+    if fmt not in ('parquet', 'arrow') or dataset not in ('rollups', 'certificates'):
+        return jsonify({"status": "error", "message": "Use format=parquet|arrow and dataset=rollups|certificates"}), 400
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return jsonify({"status": "error", "message": "Columnar export needs the pyarrow package"}), 501
+
+    if dataset == 'rollups':
+        query = db.session.query(User.username, CertificateRollup.dimension, CertificateRollup.bucket,
+                                 CertificateRollup.total).join(User, CertificateRollup.user_id == User.id).filter(
+            CertificateRollup.total > 0).order_by(User.username, CertificateRollup.dimension, CertificateRollup.bucket)
+        schema = pa.schema([('client', pa.string()), ('dimension', pa.string()), ('bucket', pa.string()),
+                            ('total', pa.int64())])
+    else:
+        query = db.session.query(*[column for _, column in EXPORT_COLUMNS.values()]).select_from(Certificate).join(
+            User, Certificate.user_id == User.id).order_by(Certificate.id)
+        schema = pa.schema([(name, pa.date32() if name == 'expiry_date' else pa.string()) for name in EXPORT_COLUMNS])
+
+    output = tempfile.TemporaryFile()
+    writer = pq.ParquetWriter(output, schema) if fmt == 'parquet' else pa.ipc.new_file(output, schema)
+    batch = []
+
+    def flush():
+        columns = list(zip(*batch))
+        writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+        batch.clear()
+
+    for row in query.execution_options(yield_per=EXPORT_BATCH_SIZE):
+        batch.append(tuple(row))
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    writer.close()
+    output.seek(0)
+    return send_file(output, as_attachment=True, download_name=f"{dataset}.{fmt}",
+                     mimetype='application/vnd.apache.parquet' if fmt == 'parquet'
+                     else 'application/vnd.apache.arrow.file')
 
 
-# --- CHARTS & PROFILE ---
-@app.route('/api/chart_data')
-@login_required
-def chart_data():
-    certs = Certificate.query.filter_by(user_id=current_user.id).all()
-    valid = len([c for c in certs if c.status == "Valid"])
-    expired = len(certs) - valid
-    return jsonify({
-        "status_labels": ["Valid", "Expired"],
-        "status_values": [valid, expired],
-        "type_labels": ["Equipment"], "type_values": [len(certs)]
-    })
+# --- QR & VERIFY ---
+# A QR code only depends on the base URL and asset id, so once rendered it never changes
+qr_memory_cache = TTLCache(maxsize=QR_CACHE_ENTRIES, ttl=QR_MAX_AGE)
+qr_pool = None
+qr_pool_lock = threading.Lock()
+
+
+def qr_base_url():
+    # The client controls the Host header, so it only stands in when no address is configured
+    return PUBLIC_BASE_URL.rstrip('/') + '/' if PUBLIC_BASE_URL else request.host_url
+
+
+def qr_url(base_url, asset_id):
+    return f"{base_url}verify/{asset_id}"
+
+
+def qr_cache_key(url, fmt):
+    return f"{hashlib.sha1(url.encode()).hexdigest()}.{fmt}"
+
+
+def cached_qr(url, fmt):
+    # Memory first, then the on-disk cache (which survives restarts and is shared by workers)
+    key = qr_cache_key(url, fmt)
+    image = qr_memory_cache.get(key)
+    if image is None and PUBLIC_BASE_URL:
+        path = os.path.join(QR_CACHE_DIR, key)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                image = f.read()
+            qr_memory_cache.set(key, image)
+    return image
+
+
+def store_qr(url, fmt, image):
+    key = qr_cache_key(url, fmt)
+    qr_memory_cache.set(key, image)
+    if not PUBLIC_BASE_URL:
+        # Host-derived urls are unbounded, so they stay in the (size-limited) memory cache
+        return
+    os.makedirs(QR_CACHE_DIR, exist_ok=True)
+    # Write then rename so other workers never read a half-written file
+    tmp_path = os.path.join(QR_CACHE_DIR, f".{key}.{uuid.uuid4().hex}")
+    with open(tmp_path, 'wb') as f:
+        f.write(image)
+    os.replace(tmp_path, os.path.join(QR_CACHE_DIR, key))
+
+
+def get_qr_pool():
+    global qr_pool
+    with qr_pool_lock:
+        if qr_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # Renderers come from a fresh fork server (or spawn) rather than forking this
+            # multi-threaded worker, so they don't inherit its locks, memory or DB sockets;
+            # qr_labels has no app imports, so they stay small
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            context = multiprocessing.get_context(method)
+            if method == 'forkserver':
+                context.set_forkserver_preload(['qr_labels'])
+            qr_pool = ProcessPoolExecutor(max_workers=QR_RENDER_PROCESSES, mp_context=context)
+        return qr_pool
+
+
+def render_qr_batch(urls):
+    # PNG bytes for each url, rendering only the ones not cached yet
+    import qr_labels
+
+    images = {url: cached_qr(url, 'png') for url in urls}
+    missing = [url for url, image in images.items() if image is None]
+    if len(missing) >= QR_POOL_THRESHOLD:
+        rendered = get_qr_pool().map(qr_labels.render_qr, missing, chunksize=32)
+    else:
+        rendered = map(qr_labels.render_qr, missing)
+    for url, image in zip(missing, rendered):
+        store_qr(url, 'png', image)
+        images[url] = image
+    return [images[url] for url in urls]
 
 
-@app.route('/api/export_csv')
+@portal.route('/generate_qr/<asset_id>')
+def generate_qr(asset_id):
+    fmt = 'svg' if request.args.get('format') == 'svg' else 'png'
+    url = qr_url(qr_base_url(), asset_id)
+    image = cached_qr(url, fmt)
+    if image is None:
+        if not Certificate.query.filter_by(asset_id=asset_id).first():
+            return "Not Found", 404
+        import qr_labels
+        image = qr_labels.render_qr(url, fmt)
+        store_qr(url, fmt, image)
+
+    response = make_response(image)
+    response.mimetype = 'image/svg+xml' if fmt == 'svg' else 'image/png'
+    response.headers['Cache-Control'] = f'public, max-age={QR_MAX_AGE}'
+    response.set_etag(qr_cache_key(url, fmt))
+    return response.make_conditional(request)
+
+
+@portal.route('/api/qr_labels')
 @login_required
-def export_csv():
-    certs = Certificate.query.filter_by(user_id=current_user.id).all()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Asset ID', 'Equipment', 'Site', 'Expiry'])
-    for c in certs:
-        writer.writerow([c.asset_id, c.equipment, c.site, c.expiry_date])
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = "attachment; filename=report.csv"
+def qr_label_sheet():
+    """Printable PDF of QR labels for a client's assets, optionally one site only.
+
+    The admin picks the client with ?client=<username>; everyone else gets their own assets.
+    """
+    query = Certificate.query
+    if current_user.is_admin:
+        if request.args.get('client'):
+            query = query.join(User, Certificate.user_id == User.id).filter(User.username == request.args['client'])
+    else:
+        query = query.filter(Certificate.user_id == current_user.id)
+    if request.args.get('site'):
+        query = query.filter(Certificate.site == request.args['site'])
+
+    asset_ids = [r.asset_id for r in query.with_entities(Certificate.asset_id).order_by(Certificate.asset_id)]
+    if not asset_ids:
+        return jsonify({"status": "error", "message": "No assets found"}), 404
+
+    import qr_labels
+
+    base_url = qr_base_url()
+    images = render_qr_batch([qr_url(base_url, a) for a in asset_ids])
+    pdf = qr_labels.build_label_sheet(list(zip(asset_ids, images)))
+    return send_file(io.BytesIO(pdf), mimetype='application/pdf', as_attachment=True,
+                     download_name='qr_labels.pdf')
+
+
+def verify_snapshot(asset_id):
+    # Read-through cache of the fields shown on the verify page, plus a strong ETag
+    snap = verify_cache.get(verify_key('snap', asset_id))
+    if snap is None:
+        cert = Certificate.query.filter_by(asset_id=asset_id).first()
+        if not cert:
+            return None
+        snap = {
+            "id": cert.id,
+            "asset_id": cert.asset_id,
+            "equipment": cert.equipment,
+            "form_type": cert.form_type,
+            "site": cert.site,
+            "inspection_date": cert.inspection_date,
+            "expiry_date": format_date(cert.expiry_date),
+            # Derived rather than read, so it is right before the day's transition has run
+            "status": status_for_expiry(cert.expiry_date),
+            "pdf_url": pdf_url(cert.pdf_path),
+        }
+        version = f"{cert.id}:{cert.version}:{cert.updated_at}:{snap['expiry_date']}:{snap['status']}:{cert.pdf_path}"
+        snap["etag"] = hashlib.sha1(version.encode()).hexdigest()
+        verify_cache.set(verify_key('snap', asset_id), snap)
+    return snap
+
+
+def public_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={VERIFY_MAX_AGE}, must-revalidate'
+    # Logged-in staff get a different page, so shared caches must key on the session cookie
+    response.headers['Vary'] = 'Cookie'
     return response
 
 
-# --- QR & VERIFY ---
-"""
-@app.route('/generate_qr/<asset_id>')
-def generate_qr(asset_id):
-    qr = qrcode.make(f"{request.host_url}verify/{asset_id}")
-    buf = io.BytesIO()
-    qr.save(buf, format='PNG')
-    buf.seek(0)
-    return send_file(buf, mimetype='image/png')
-"""
-
-@app.route('/verify/<asset_id>')
+@portal.route('/verify/<asset_id>')
 def verify(asset_id):
-    cert = Certificate.query.filter_by(asset_id=asset_id).first()
-    if cert:
-        return render_template('verify_status.html', data=cert)
-    return "Not Found", 404
-
+    snap = verify_snapshot(asset_id)
+    if not snap:
+        return "Not Found", 404
 
-@app.route('/api/field_upload', methods=['POST'])
+    if current_user.is_authenticated:
+        # Staff see the upload tools, so their copy is never cached or shared
+        response = make_response(render_template('verify_status.html', data=snap))
+        response.headers['Cache-Control'] = 'private, no-store'
+        return response
+
+    if snap["etag"] in request.if_none_match:
+        return public_cache_headers(make_response('', 304), snap["etag"])
+
+    html = verify_cache.get(verify_key('html', asset_id))
+    if html is None:
+        html = render_template('verify_status.html', data=snap)
+        verify_cache.set(verify_key('html', asset_id), html)
+    return public_cache_headers(make_response(html), snap["etag"])
+
+
+@portal.route('/api/verify/<asset_id>')
+def verify_json(asset_id):
+    # Compact variant for the mobile scanner
+    snap = verify_snapshot(asset_id)
+    if not snap:
+        return jsonify({"status": "error", "message": "Not Found"}), 404
+    # Same version as the HTML page, but a distinct tag since it's a different representation
+    etag = snap["etag"] + "-json"
+    if etag in request.if_none_match:
+        return public_cache_headers(make_response('', 304), etag)
+
+    return public_cache_headers(jsonify({
+        "id": snap["asset_id"],
+        "type": snap["equipment"],
+        "site": snap["site"],
+        "inspected": snap["inspection_date"],
+        "expiry": snap["expiry_date"],
+        "status": snap["status"],
+        "valid": snap["status"] in ("Valid", "Pass"),
+    }), etag)
+
+
+@portal.route('/api/field_upload', methods=['POST'])
 @login_required  # THIS ENSURES IT IS PRIVATE
 def field_upload():
     asset_id = request.form.get('asset_id')
@@ -521,46 +3069,189 @@ def field_upload():
     cert = Certificate.query.filter_by(asset_id=asset_id).first()
 
     if cert:
-        # Save file to static/pdfs folder
-        filename = secure_filename(f"{asset_id}.pdf")
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-
-        # Update the database record
-        cert.pdf_path = filename
+        # Store the file (deduplicated by content) and update the database record
+        replicate = attach_pdf(cert, file)
+        queue_sheet_sync(asset_id)
         db.session.commit()
+        dashboard_cache.invalidate(cert.user_id)
+        invalidate_verify(asset_id)
 
+        if replicate:
+            queue_replication(replicate, f"{asset_id}.pdf")
         return jsonify({"status": "success"})
 
     return jsonify({"status": "error", "message": "Asset not found"}), 404
 
 
-@app.route('/api/admin/sync_data')
+@portal.route('/pdfs/<sha256>')
+def serve_pdf(sha256):
+    # Content-addressed, so the bytes behind a URL never change. send_file handles Range
+    # requests and conditional GETs, or hands the file to the web server with X-Sendfile.
+    blob = db.session.get(PdfBlob, sha256)
+    if not blob:
+        abort(404)
+    path = pdf_store_path(sha256)
+    if not os.path.exists(path):
+        # The local disk was wiped (e.g. a fresh cloud instance); fall back to the Drive copy
+        if blob.drive_link:
+            return redirect(blob.drive_link)
+        abort(404)
+    response = send_file(path, mimetype=blob.content_type, conditional=True, etag=sha256,
+                         max_age=365 * 24 * 3600)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@portal.app_errorhandler(413)
+def upload_too_large(e):
+    limit_mb = current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({"status": "error", "message": f"Upload too large (limit {limit_mb} MB)"}), 413
+
+
+@portal.route('/api/admin/sync_data')
 @login_required
 def admin_sync():
-    # You can restrict this to only 'admin' user if you want
-    if current_user.username != 'admin':
+    if not current_user.is_admin:
         return jsonify({"message": "Unauthorized"}), 403
 
     sync_to_google_sheets()
     return jsonify({"status": "success", "message": "Google Sheet Updated!"})
 
 
-@app.route('/api/check_session')
+@portal.route('/api/admin/google_metrics')
+@login_required
+def admin_google_metrics():
+    if not current_user.is_admin:
+        return jsonify({"message": "Unauthorized"}), 403
+    return jsonify(api_metrics.snapshot())
+
+
+@portal.route('/api/admin/cache_stats')
+@login_required
+def admin_cache_stats():
+    if not current_user.is_admin:
+        return jsonify({"message": "Unauthorized"}), 403
+    return jsonify(dashboard_cache.stats())
+
+
+@portal.route('/api/admin/health')
+@login_required
+def admin_health():
+    if not current_user.is_admin:
+        return jsonify({"message": "Unauthorized"}), 403
+
+    start = time.perf_counter()
+    try:
+        db.session.execute(text('SELECT 1'))
+        db_ok = True
+    except Exception as e:
+        print(f"Health Check Error: {e}")
+        db_ok = False
+    round_trip_ms = (time.perf_counter() - start) * 1000
+
+    pool = db.engine.pool
+    pool_info = {"class": type(pool).__name__, "status": pool.status()}
+    if hasattr(pool, 'checkedout'):
+        pool_info.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+
+    return jsonify({
+        "status": "ok" if db_ok else "error",
+        "database": db.engine.dialect.name,
+        "db_round_trip_ms": round(round_trip_ms, 2),
+        "pool": pool_info,
+        "engine_options": current_app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+        "slow_query_ms": SLOW_QUERY_MS,
+        "stats": db_stats.snapshot(),
+    }), 200 if db_ok else 503
+
+
+@portal.route('/metrics')
+def metrics():
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+            return "Unauthorized", 401
+    elif not (current_user.is_authenticated and current_user.is_admin):
+        return "Unauthorized", 401
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@portal.route('/api/admin/profiles/<name>')
+@login_required
+def admin_profile_report(name):
+    if not current_user.is_admin:
+        return jsonify({"message": "Unauthorized"}), 403
+    path = os.path.join(PROFILE_DIR, os.path.basename(name) + '.txt')
+    if not os.path.exists(path):
+        return jsonify({"status": "error", "message": "Report not found"}), 404
+    return send_file(path, mimetype='text/plain')
+
+
+@portal.route('/api/check_session')
 def check_session():
     if current_user.is_authenticated:
         return jsonify({
             "status": "authenticated", 
-            "user": current_user.username
+            "user": current_user.username,
+            "role": current_user.role
         }), 200
     return jsonify({"status": "unauthenticated"}), 401
 
 
-@app.route('/api/logout')
+@portal.route('/api/logout')
 @login_required
 def logout():
     logout_user()
     return jsonify({"status": "success"})
 
 
+# --- APPLICATION FACTORY ---
+def create_app(config=None):
+    """Build and configure the app. Importing main and calling this does no database or
+    Google I/O; run `flask --app main init-db` once per deploy to create the schema."""
+    app = Flask(__name__, template_folder='template', instance_path=INSTANCE_DIR)
+    app.config['SECRET_KEY'] = 'RR_SOLUTIONS_SECRET_KEY'
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['UPLOAD_FOLDER'] = 'static/pdfs'
+    # Uploaded PDFs are stored once per SHA-256 under the instance folder
+    app.config['PDF_STORE_DIR'] = os.environ.get('PDF_STORE_DIR', os.path.join(INSTANCE_DIR, 'pdf_store'))
+    # Requests bigger than this are rejected with 413 before the body is read
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 32)) * 1024 * 1024
+    # Let nginx/Apache stream stored PDFs instead of the worker
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    if TRUSTED_PROXY_HOPS:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(portal)
+
+    if not os.path.exists(app.config['UPLOAD_FOLDER']):
+        os.makedirs(app.config['UPLOAD_FOLDER'])
+    return app
+
+
+def start_background_workers(app):
+    """Start the expiry scheduler and sheet sync threads in a process that serves requests.
+
+    Called by gunicorn.conf.py in each worker and by `python main.py`, never on import, so CLI
+    commands (init-db, send-digests, ...) and scripts don't race their own background runs.
+    """
+    if os.environ.get('EXPIRY_SCHEDULER', '1') == '1':
+        start_expiry_scheduler(app)
+
+    if os.environ.get('SHEET_SYNC_WORKER', '1') == '1':
+        start_sheet_sync_worker(app)
+
+
+# gunicorn main:app
+app = create_app()
+
+
 if __name__ == '__main__':
+    start_background_workers(app)
     app.run(debug=True)
\ No newline at end of file
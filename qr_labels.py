@@ -0,0 +1,58 @@
+"""QR code rendering for asset labels.
+
+This module only depends on qrcode and Pillow (no Flask or database), so the label
+batch can render codes in a process pool without every worker importing the app.
+"""
+import io
+
+import qrcode
+import qrcode.image.svg
+from PIL import Image, ImageDraw, ImageFont
+
+# Label sheets are laid out on A4 at 150 DPI
+PAGE_SIZE = (1240, 1754)
+PAGE_MARGIN = 60
+PAGE_DPI = 150
+
+
+def render_qr(url, fmt='png'):
+    # Returns the encoded image bytes for one QR code
+    if fmt == 'svg':
+        img = qrcode.make(url, image_factory=qrcode.image.svg.SvgPathImage)
+    else:
+        img = qrcode.make(url, box_size=8, border=2)
+    buf = io.BytesIO()
+    img.save(buf)
+    return buf.getvalue()
+
+
+def build_label_sheet(labels, columns=3, rows=6):
+    """Lay (caption, png_bytes) labels out in a grid and return a multi-page PDF."""
+    cell_w = (PAGE_SIZE[0] - 2 * PAGE_MARGIN) // columns
+    cell_h = (PAGE_SIZE[1] - 2 * PAGE_MARGIN) // rows
+    caption_h = 40
+    qr_size = min(cell_w, cell_h - caption_h) - 20
+    font = ImageFont.load_default(size=24)
+
+    per_page = columns * rows
+    pages = []
+    for start in range(0, max(len(labels), 1), per_page):
+        page = Image.new('L', PAGE_SIZE, 255)
+        draw = ImageDraw.Draw(page)
+        for i, (caption, png) in enumerate(labels[start:start + per_page]):
+            x = PAGE_MARGIN + (i % columns) * cell_w
+            y = PAGE_MARGIN + (i // columns) * cell_h
+            qr = Image.open(io.BytesIO(png)).convert('L').resize((qr_size, qr_size), Image.NEAREST)
+            page.paste(qr, (x + (cell_w - qr_size) // 2, y))
+            while len(caption) > 4 and draw.textlength(caption, font=font) > cell_w - 10:
+                caption = caption[:-2] + '…'
+            text_w = draw.textlength(caption, font=font)
+            draw.text((x + (cell_w - text_w) / 2, y + qr_size + 8), caption, fill=0, font=font)
+            # Cut guides around each label
+            draw.rectangle([x, y - 10, x + cell_w - 1, y + cell_h - 11], outline=0)
+        # Black and white pages keep the PDF small (a few KB per page instead of hundreds)
+        pages.append(page.convert('1', dither=Image.Dither.NONE))
+
+    buf = io.BytesIO()
+    pages[0].save(buf, 'PDF', save_all=True, append_images=pages[1:], resolution=PAGE_DPI)
+    return buf.getvalue()
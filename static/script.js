@@ -23,20 +23,20 @@ if (mobileMenu) {
 /* =====================================================
    RECOVERED: NOTIFICATION SYSTEM (Using Toasts)
 ===================================================== */
-async function checkNotifications() {
-    try {
-        const response = await fetch('/api/notifications');
-        const alerts = await response.json();
-
-        if (alerts && alerts.length > 0) {
-            alerts.forEach(a => {
-                // Determine toast type based on urgency
-                const type = a.type === 'urgent' ? 'error' : 'info';
-                showFlash(`Asset #${a.id}: ${a.msg}`, type);
-            });
-        }
-    } catch (error) {
-        console.error("Notification Error:", error);
+function showAlerts(alerts) {
+    const unread = (alerts || []).filter(a => !a.read);
+    if (unread.length > 0) {
+        unread.forEach(a => {
+            // Determine toast type based on urgency
+            const type = a.type === 'urgent' ? 'error' : 'info';
+            showFlash(`Asset #${a.id}: ${a.msg}`, type);
+        });
+        // Each alert pops up once; it stays listed under /api/notifications
+        fetch('/api/notifications/read', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ ids: unread.map(a => a.notification_id) })
+        }).catch(error => console.error("Notification Error:", error));
     }
 }
 
@@ -109,18 +109,18 @@ async function handleAuth() {
 
     if (res.ok) {
         if (isLoginMode) {
+            const result = await res.json();
             document.getElementById("login-page").classList.add("hidden");
             document.getElementById("app").classList.remove("hidden");
             
             const addLink = document.getElementById('admin-add-link');
-            if (u !== 'admin') {
+            if (result.role !== 'admin') {
                 if(addLink) addLink.style.display = 'none';
             } else {
                 if(addLink) addLink.style.display = 'block';
             }
             
             showSection("dashboard");
-            checkNotifications();
         } else {
             showFlash("Account created! Please login.", "success");
             toggleAuth();
@@ -177,8 +177,13 @@ async function adminCreateUser() {
 ===================================================== */
 async function loadDashboard() {
   try {
-    const response = await fetch("/api/dashboard_stats");
-    const stats = await response.json();
+    // Stats and expiry alerts come back together from one request
+    const response = await fetch("/api/dashboard");
+    const { stats, notifications } = await response.json();
+    if (!alertsShown) {
+      alertsShown = true;
+      showAlerts(notifications);
+    }
     document.getElementById("stat-total").innerText = stats.total;
     document.getElementById("stat-valid").innerText = stats.valid;
     document.getElementById("stat-soon").innerText = stats.soon;
@@ -200,49 +205,116 @@ document.querySelectorAll('nav a').forEach(link => {
     });
 });
 
-async function loadInventory() {
+// PDFs open straight away; the Drive backup copy finishes in the background
+function pdfLabel(c) {
+  if (c.pdf_status === 'pending') return 'View PDF (syncing)';
+  if (c.pdf_status === 'failed') return 'View PDF (not backed up)';
+  return 'View PDF';
+}
+
+function certCardHtml(c) {
+    const statusClass = c.status === 'Expired' ? 'bg-danger' : 'bg-success';
+    const safetyText = c.status === 'Expired' ? 'Expired' : 'Verified';
+
+    return `
+    <div class="card" style="padding: 15px; border-top: 4px solid ${c.status === 'Expired' ? '#dc3545' : '#28a745'};">
+        <div style="display:flex; justify-content: space-between; align-items: flex-start;">
+            <div>
+                <small class="text-muted">ID: ${c.id}</small><br>
+                <span class="badge" style="background: #e7f1ff; color: #007bff; font-size: 0.6rem; padding: 2px 5px; border: 1px solid #007bff; border-radius: 4px; display: inline-block; margin-top: 5px;">
+                    ${c.renewal_status || 'Not Started'}
+                </span>
+            </div>
+            <span class="badge ${statusClass}" style="font-size: 0.7rem;">${safetyText}</span>
+        </div>
+        <h3 style="margin: 10px 0;">${c.type}</h3>
+        <p class="small">Site: ${c.site || 'N/A'}</p>
+        <div style="text-align:center; margin: 15px 0;">
+            <img src="/generate_qr/${c.id}" width="100" style="border: 1px solid #eee; padding: 5px;">
+        </div>
+        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 10px;">
+            <a href="${c.pdf}" target="_blank" class="btn-small" style="text-align:center; text-decoration:none; background: ${c.pdf_status === 'failed' ? '#dc3545' : '#007bff'}; color:white; ${!c.pdf ? 'pointer-events: none; opacity: 0.5;' : ''}">${pdfLabel(c)}</a>
+            <button onclick="deleteCertificate('${c.id}')" class="btn-small" style="background: #dc3545; color:white; border:none;">Delete</button>
+        </div>
+    </div>`;
+}
+
+// The inventory is fetched one page at a time; "Load More" continues from the last cursor
+const INVENTORY_PAGE_SIZE = 24;
+let inventoryCursor = null;
+
+async function loadInventory(append = false) {
   try {
-      const res = await fetch("/api/certificates");
-      const certs = await res.json();
+      const params = new URLSearchParams({ limit: INVENTORY_PAGE_SIZE, sort: "expiry" });
+      if (append && inventoryCursor) params.set("cursor", inventoryCursor);
+      const res = await fetch(`/api/certificates/page?${params}`);
+      const page = await res.json();
+      const certs = page.items;
+      inventoryCursor = page.next_cursor;
+
       const grid = document.getElementById("cert-display-grid");
-      
+      const loadMore = document.getElementById("cert-load-more");
+      if (loadMore) loadMore.style.display = inventoryCursor ? "block" : "none";
+
       if (!grid) return;
-      if (certs.length === 0) {
+      if (!append && certs.length === 0) {
           grid.innerHTML = "<p class='text-muted'>No certificates found. Add your first inspection!</p>";
           return;
       }
 
-      grid.innerHTML = certs.map(c => {
-          const statusClass = c.status === 'Expired' ? 'bg-danger' : 'bg-success';
-          const safetyText = c.status === 'Expired' ? 'Expired' : 'Verified';
-
-          return `
-          <div class="card" style="padding: 15px; border-top: 4px solid ${c.status === 'Expired' ? '#dc3545' : '#28a745'};">
-              <div style="display:flex; justify-content: space-between; align-items: flex-start;">
-                  <div>
-                      <small class="text-muted">ID: ${c.id}</small><br>
-                      <span class="badge" style="background: #e7f1ff; color: #007bff; font-size: 0.6rem; padding: 2px 5px; border: 1px solid #007bff; border-radius: 4px; display: inline-block; margin-top: 5px;">
-                          ${c.renewal_status || 'Not Started'}
-                      </span>
-                  </div>
-                  <span class="badge ${statusClass}" style="font-size: 0.7rem;">${safetyText}</span>
-              </div>
-              <h3 style="margin: 10px 0;">${c.type}</h3>
-              <p class="small">Site: ${c.site || 'N/A'}</p>
-              <div style="text-align:center; margin: 15px 0;">
-                  <img src="/generate_qr/${c.id}" width="100" style="border: 1px solid #eee; padding: 5px;">
-              </div>
-              <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 10px;">
-                  <a href="${c.pdf_path}" target="_blank" class="btn-small" style="text-align:center; text-decoration:none; background: #007bff; color:white; ${!c.pdf ? 'pointer-events: none; opacity: 0.5;' : ''}">View PDF</a>
-                  <button onclick="deleteCertificate('${c.id}')" class="btn-small" style="background: #dc3545; color:white; border:none;">Delete</button>
-              </div>
-          </div>`;
-      }).join("");
+      const html = certs.map(certCardHtml).join("");
+      if (append) grid.insertAdjacentHTML("beforeend", html);
+      else grid.innerHTML = html;
   } catch (err) {
       console.error("Failed to load inventory:", err);
   }
 }
 
+// Type-ahead search over asset ID, equipment and site; "KA262-FB*" matches a prefix
+let searchQuery = "";
+let searchOffset = null;
+let searchTimer = null;
+
+async function performInventorySearch(append = false) {
+  const input = document.getElementById("inventory-search-input");
+  const q = append ? searchQuery : input.value.trim();
+  if (!q) return loadInventory();
+  searchQuery = q;
+  try {
+      const params = new URLSearchParams({ q, limit: INVENTORY_PAGE_SIZE });
+      if (append && searchOffset) params.set("offset", searchOffset);
+      const res = await fetch(`/api/search?${params}`);
+      const page = await res.json();
+      // Ignore responses for a query the user has already typed past
+      if (!append && q !== input.value.trim()) return;
+      searchOffset = page.next_offset;
+
+      const grid = document.getElementById("cert-display-grid");
+      const loadMore = document.getElementById("cert-load-more");
+      if (loadMore) loadMore.style.display = "none";
+      const html = page.items.map(certCardHtml).join("");
+      if (append) {
+          document.getElementById("search-more")?.remove();
+          grid.insertAdjacentHTML("beforeend", html);
+      } else {
+          grid.innerHTML = html || "<p class='text-muted'>No assets match your search.</p>";
+      }
+      if (searchOffset) {
+          grid.insertAdjacentHTML("beforeend",
+              `<div id="search-more" style="grid-column: 1 / -1; text-align: center;"><button onclick="performInventorySearch(true)" class="btn-small" style="background: #007bff; color: white; border: none; padding: 10px 20px; border-radius: 5px; cursor: pointer;">More Results</button></div>`);
+      }
+  } catch (err) {
+      console.error("Search failed:", err);
+  }
+}
+
+// Delegated, because this script runs before the page body exists
+document.addEventListener("input", (e) => {
+    if (e.target.id !== "inventory-search-input") return;
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => performInventorySearch(), 250);
+});
+
 /* =====================================================
    RETEST / RENEWAL REQUEST
 ===================================================== */
@@ -308,8 +380,25 @@ async function uploadCertificate(e) {
     fd.append("expiry_date", document.getElementById("new-expiry").value);
     fd.append("pdf_file", document.getElementById("new-pdf").files[0]);
 
-    const res = await fetch("/api/add_certificate", { method: "POST", body: fd });
-    if (res.ok) { showFlash("Certificate saved and synced!", "success"); showSection("certificates"); }
+    // One key per filled-in form: a double click or a retry after a dropped connection
+    // gets the first response back instead of saving twice
+    const form = e.target;
+    if (!form.dataset.idempotencyKey) {
+        form.dataset.idempotencyKey = window.crypto && crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random()}`;
+    }
+
+    const res = await fetch("/api/add_certificate", {
+        method: "POST",
+        headers: { "Idempotency-Key": form.dataset.idempotencyKey },
+        body: fd
+    });
+    if (res.ok) {
+        delete form.dataset.idempotencyKey;
+        const result = await res.json();
+        const msg = result.pdf_status === 'pending' ? "Certificate saved! The PDF is backing up to Drive in the background." : "Certificate saved and synced!";
+        showFlash(msg, "success");
+        showSection("certificates");
+    }
     else { showFlash("Error Saving The Certificate!", "danger"); }
 }
 
@@ -330,13 +419,12 @@ window.onload = async () => {
           document.getElementById("login-page").classList.add("hidden");
           document.getElementById("app").classList.remove("hidden");
           const addLink = document.getElementById('admin-add-link');
-          if (result.user !== 'admin') {
+          if (result.role !== 'admin') {
               if(addLink) addLink.style.display = 'none';
           } else {
               if(addLink) addLink.style.display = 'block';
           }
           showSection("dashboard");
-          checkNotifications(); 
       }
   } catch (err) { console.error("Session check failed", err); }
 };